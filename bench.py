@@ -0,0 +1,250 @@
+"""Offline replay benchmark for the update pipeline
+
+Drives synthetic updates through a real PTB Application with the bot's handlers, against a
+stubbed Bot API and a throwaway database, and reports throughput, latency, SQLite statements
+per update and peak memory for each workload:
+
+    python bench.py --channels 200 --images 10 --posts 2000 --rate 500
+    python bench.py --save benchmarks/baseline.json
+    python bench.py --compare benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+
+# Point storage at a scratch database before anything imports it
+os.environ["BOT_DATA_DIR"] = tempfile.mkdtemp(prefix="bench_")
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import bot
+import storage
+from coalesce import POSTS_SKIPPED
+from dispatcher import KeyedUpdateProcessor
+from ratelimit import PriorityRateLimiter
+
+OWNER_ID = 1000
+RED_POST = "🔴 {time} світло зникло\nНаступне ввімкнення за графіком о 21:00"
+GREEN_POST = "🟢 {time} Світло з'явилося\nСвітло було відсутнє 3 год 21 хв"
+OTHER_POST = "Графік погодинних відключень на завтра:\n" + "Черга 1.1: 00:00-04:00, 08:00-12:00\n" * 6
+
+class StubRequest(BaseRequest):
+    """Answers every Bot API call locally, optionally after a simulated round trip"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        message = {"message_id": 1, "date": int(time.time()),
+                   "chat": {"id": params.get("chat_id", OWNER_ID), "type": "private"}}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif endpoint == "sendMediaGroup":
+            result = [message] * len(params.get("media", [None]))
+        elif endpoint.startswith(("send", "edit")):
+            result = message
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def channel_post(update_id, channel_id, text):
+    return {"update_id": update_id, "channel_post": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": channel_id, "type": "channel", "title": f"Канал {channel_id}", "username": f"chan{-channel_id}"},
+    }}
+
+def private_message(update_id, user_id, text=None, photo=None):
+    message = {"message_id": update_id, "date": int(time.time()),
+               "chat": {"id": user_id, "type": "private"},
+               "from": {"id": user_id, "is_bot": False, "first_name": "admin"}}
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if photo is not None:
+        message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1280, "height": 720}]
+    return {"update_id": update_id, "message": message}
+
+def seed(channels, images):
+    channel_ids = [-1001000000000 - i for i in range(channels)]
+    for i, channel_id in enumerate(channel_ids):
+        owner_id = OWNER_ID + i
+        storage.set_channel_owner(channel_id, owner_id, f"chan{-channel_id}", f"Канал {channel_id}")
+        storage.set_user_active_channel(owner_id, channel_id)
+        for color in ("red", "green"):
+            for n in range(images):
+                storage.add_channel_image(channel_id, color, f"{color}-{channel_id}-{n}")
+    return channel_ids
+
+def post_workload(channel_ids, posts, rng):
+    texts = [RED_POST, GREEN_POST, OTHER_POST]
+    return [channel_post(i, rng.choice(channel_ids), rng.choices(texts, weights=(4, 4, 2))[0].format(time="17:42"))
+            for i in range(posts)]
+
+def outage_workload(channel_ids, posts, rng):
+    # Every channel reports the outage at once, then power comes back
+    updates = [channel_post(i, channel_id, RED_POST.format(time="17:42")) for i, channel_id in enumerate(channel_ids)]
+    updates += [channel_post(len(updates) + i, channel_id, GREEN_POST.format(time="21:03"))
+                for i, channel_id in enumerate(channel_ids)]
+    return updates[:posts]
+
+def admin_workload(channel_ids, posts, rng):
+    updates = []
+    commands = ["/status", "/list_red", "/phrases"]
+    while len(updates) < posts:
+        user_id = OWNER_ID + rng.randrange(len(channel_ids))
+        if rng.random() < 0.5:
+            updates.append(private_message(len(updates), user_id, rng.choice(commands)))
+        else:
+            updates.append(private_message(len(updates), user_id, "/add_green"))
+            updates.append(private_message(len(updates), user_id, photo=f"upload-{len(updates)}"))
+    return updates[:posts]
+
+WORKLOADS = {
+    "channel_posts": post_workload,
+    "outage_burst": outage_workload,
+    "admin_commands": admin_workload,
+}
+
+def skipped_posts():
+    return sum(value for _, _, value in POSTS_SKIPPED.samples())
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+async def run_workload(app, raw_updates, rate):
+    """Feed updates at `rate` per second (0 = all at once) and time each one end to end"""
+    statements = [0]
+    await storage.run_db(lambda: storage.get_connection().set_trace_callback(lambda sql: statements.__setitem__(0, statements[0] + 1)))
+    updates = [Update.de_json(data, app.bot) for data in raw_updates]
+    latencies = []
+
+    async def process(update):
+        start = time.perf_counter()
+        await app.update_processor.process_update(update, app.process_update(update))
+        latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    tasks = []
+    for i, update in enumerate(updates):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(process(update)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await storage.run_db(lambda: storage.get_connection().set_trace_callback(None))
+
+    return {
+        "updates": len(updates),
+        "updates_per_sec": round(len(updates) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "sqlite_statements_per_update": round(statements[0] / len(updates), 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+async def run(args):
+    storage.init_db()
+    rng = random.Random(args.seed)
+    channel_ids = seed(args.channels, args.images)
+
+    request = StubRequest(args.api_latency)
+    builder = Application.builder().token("1:bench").request(request).get_updates_request(StubRequest())
+    builder = builder.concurrent_updates(KeyedUpdateProcessor(args.concurrency, on_arrival=bot.recent_posts.arrived))
+    if args.rate_limiter:
+        builder = builder.rate_limiter(PriorityRateLimiter())
+    app = builder.build()
+    bot.add_handlers(app)
+    # A burst sent all at once looks like one long flap, which would leave most status posts
+    # unedited; without --coalesce every post is handled, as in runs recorded before coalescing
+    if not args.coalesce:
+        bot.recent_posts.flap_window = 0
+
+    results = {}
+    async with app:
+        for name in args.workloads:
+            updates = WORKLOADS[name](channel_ids, args.posts, rng)
+            # Message ids restart with every workload, they must not look like repeated posts
+            bot.recent_posts.clear()
+            skipped = skipped_posts()
+            results[name] = await run_workload(app, updates, args.rate)
+            results[name]["api_calls"] = request.calls
+            results[name]["posts_skipped"] = skipped_posts() - skipped
+            request.calls = 0
+    await storage.shutdown_db()
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print each number next to its baseline; return False if anything regressed"""
+    ok = True
+    higher_is_better = {"updates_per_sec"}
+    for workload, numbers in results.items():
+        for key, value in numbers.items():
+            base = baseline.get(workload, {}).get(key)
+            if not isinstance(base, (int, float)) or not base:
+                continue
+            change = (value - base) / base
+            regressed = change < -tolerance if key in higher_is_better else change > tolerance
+            if key in ("updates", "api_calls", "posts_skipped"):
+                regressed = False
+            ok = ok and not regressed
+            print(f"{workload:15} {key:30} {base:>12} -> {value:>12} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=200)
+    parser.add_argument("--images", type=int, default=10, help="images per status per channel")
+    parser.add_argument("--posts", type=int, default=2000, help="updates per workload")
+    parser.add_argument("--rate", type=float, default=0, help="updates per second, 0 sends the whole burst at once")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API round trip in seconds")
+    parser.add_argument("--rate-limiter", action="store_true", help="include the outbound rate limiter")
+    parser.add_argument("--coalesce", action="store_true", help="skip status posts superseded within FLAP_WINDOW, as the bot does")
+    parser.add_argument("--workloads", nargs="+", choices=sorted(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", metavar="PATH", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    results["params"] = {key: value for key, value in vars(args).items() if key not in ("save", "compare", "tolerance")}
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare({k: v for k, v in results.items() if k != "params"}, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
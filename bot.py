@@ -1,165 +1,121 @@
-import re
-import sqlite3
+import time
+# Boot phases are measured from here, so the breakdown includes the imports below
+BOOT_STARTED = time.perf_counter()
 import os
-import json
-import random
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-
-# Use data directory outside git repo
-DB_DIR = os.path.expanduser("~/telegram_bot_data")
-os.makedirs(DB_DIR, exist_ok=True)
-DB_FILE = os.path.join(DB_DIR, "config.db")
-
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS channels (
-            channel_id INTEGER PRIMARY KEY,
-            owner_id INTEGER,
-            red_image TEXT,
-            green_image TEXT,
-            channel_username TEXT,
-            channel_title TEXT
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS user_sessions (
-            user_id INTEGER PRIMARY KEY,
-            active_channel_id INTEGER
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def get_channel_config(channel_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.execute("SELECT owner_id, red_image, green_image, channel_username, channel_title FROM channels WHERE channel_id = ?", (channel_id,))
-    row = cur.fetchone()
-    conn.close()
-    if row:
-        # Parse JSON arrays for images, fallback to single image for backward compatibility
-        red_images = json.loads(row[1]) if row[1] and row[1].startswith('[') else ([row[1]] if row[1] else [])
-        green_images = json.loads(row[2]) if row[2] and row[2].startswith('[') else ([row[2]] if row[2] else [])
-        return {
-            "owner_id": row[0], 
-            "red_images": red_images, 
-            "green_images": green_images, 
-            "channel_username": row[3], 
-            "channel_title": row[4]
-        }
-    return {"owner_id": None, "red_images": [], "green_images": [], "channel_username": None, "channel_title": None}
-
-def set_channel_owner(channel_id, owner_id, username=None, title=None):
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("INSERT OR IGNORE INTO channels (channel_id, owner_id, channel_username, channel_title) VALUES (?, ?, ?, ?)", 
-                 (channel_id, owner_id, username, title))
-    conn.commit()
-    conn.close()
-
-def update_channel_info(channel_id, username=None, title=None):
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("UPDATE channels SET channel_username = ?, channel_title = ? WHERE channel_id = ?", 
-                 (username, title, channel_id))
-    conn.commit()
-    conn.close()
-
-def set_user_active_channel(user_id, channel_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("INSERT OR REPLACE INTO user_sessions (user_id, active_channel_id) VALUES (?, ?)", 
-                 (user_id, channel_id))
-    conn.commit()
-    conn.close()
-
-def get_user_active_channel(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.execute("SELECT active_channel_id FROM user_sessions WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
-
-def update_channel_image(channel_id, color, file_id):
-    """Replace all images with a single one (for /set_red and /set_green)"""
-    conn = sqlite3.connect(DB_FILE)
-    images_json = json.dumps([file_id])
-    if color == "red":
-        conn.execute("UPDATE channels SET red_image = ? WHERE channel_id = ?", (images_json, channel_id))
-    else:
-        conn.execute("UPDATE channels SET green_image = ? WHERE channel_id = ?", (images_json, channel_id))
-    conn.commit()
-    conn.close()
-
-def add_channel_image(channel_id, color, file_id):
-    """Add an image to existing collection"""
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.execute("SELECT red_image, green_image FROM channels WHERE channel_id = ?", (channel_id,))
-    row = cur.fetchone()
-    
-    if row:
-        if color == "red":
-            current = json.loads(row[0]) if row[0] and row[0].startswith('[') else ([row[0]] if row[0] else [])
-            current.append(file_id)
-            conn.execute("UPDATE channels SET red_image = ? WHERE channel_id = ?", (json.dumps(current), channel_id))
-        else:
-            current = json.loads(row[1]) if row[1] and row[1].startswith('[') else ([row[1]] if row[1] else [])
-            current.append(file_id)
-            conn.execute("UPDATE channels SET green_image = ? WHERE channel_id = ?", (json.dumps(current), channel_id))
-    
-    conn.commit()
-    conn.close()
-
-def remove_channel_image(channel_id, color, index):
-    """Remove an image by index"""
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.execute("SELECT red_image, green_image FROM channels WHERE channel_id = ?", (channel_id,))
-    row = cur.fetchone()
-    
-    if row:
-        if color == "red":
-            current = json.loads(row[0]) if row[0] and row[0].startswith('[') else ([row[0]] if row[0] else [])
-            if 0 <= index < len(current):
-                current.pop(index)
-                conn.execute("UPDATE channels SET red_image = ? WHERE channel_id = ?", (json.dumps(current), channel_id))
-        else:
-            current = json.loads(row[1]) if row[1] and row[1].startswith('[') else ([row[1]] if row[1] else [])
-            if 0 <= index < len(current):
-                current.pop(index)
-                conn.execute("UPDATE channels SET green_image = ? WHERE channel_id = ?", (json.dumps(current), channel_id))
-    
-    conn.commit()
-    conn.close()
-
-def transfer_ownership(channel_id, new_owner_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("UPDATE channels SET owner_id = ? WHERE channel_id = ?", (new_owner_id, channel_id))
-    conn.commit()
-    conn.close()
-
-def remove_channel(channel_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
-    conn.commit()
-    conn.close()
-
-def is_owner(channel_id, user_id):
-    config = get_channel_config(channel_id)
-    return config["owner_id"] is None or config["owner_id"] == user_id
+import io
+import sys
+import signal
+import asyncio
+import zlib
+from telegram import Update, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from storage import (
+    init_storage, ainit_db, shutdown_db, aget_channel_config, aget_session, aset_channel_owner, aupdate_channel_info,
+    aset_user_active_channel, aupdate_channel_image, aadd_channel_image, aadd_channel_images,
+    aremove_channel_image, aadd_channel_rule, aclear_channel_rules, aadd_channel_status, aremove_channel_status,
+    atransfer_ownership, aremove_channel, amark_image_dead, aexport_channels, aimport_channels_file, export_channels_file, import_channels_file,
+)
+from classifier import BUILTIN_STATUSES, STATUS_NAME, get_classifier
+from rotation import draw_image
+from media import photo_record, is_bad_file, verify_media
+from maintenance import run_maintenance
+from dispatcher import KeyedUpdateProcessor, received_at
+from coalesce import PostWindow
+from ratelimit import PriorityRateLimiter
+from persistence import StatePersistence
+from metrics import CLASSIFY_SECONDS, POST_EDIT_SECONDS, BootTimer, timed_handler
+from tracing import span, traced_handler
+from web import create_web_app, start_web_server, stop_web_server
+
+boot = BootTimer(BOOT_STARTED)
+boot.mark("imports")
+
+# Telegram albums hold at most 10 photos
+LIST_PAGE_SIZE = 10
+# Album photos arrive as separate updates; an album is complete once none came for this long
+ALBUM_DELAY = 1.0
+
+# (user_id, media_group_id) -> photos collected in bulk mode, waiting to be committed together
+_albums = {}
+# Recent channel posts, to skip repeated deliveries and posts a newer status already replaced
+recent_posts = PostWindow(int(os.getenv("POST_WINDOW", 300)), float(os.getenv("FLAP_WINDOW", 10)))
+
+async def get_owned_channel(update: Update):
+    """Resolve the sender's active channel and check ownership in one session lookup
+    
+    Replies with the reason and returns (None, None) when the command can't proceed.
+    """
+    user_id = update.effective_user.id
+    channel_id, config = await aget_session(user_id)
+    
+    if not channel_id:
+        await update.effective_message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
+        return None, None
+    
+    if config["owner_id"] is not None and config["owner_id"] != user_id:
+        await update.effective_message.reply_text("❌ Ви не є власником цього каналу")
+        return None, None
+    
+    return channel_id, config
+
+def status_label(config, status):
+    return dict(config["statuses"]).get(status, status)
+
+async def get_owned_status(update: Update, context: ContextTypes.DEFAULT_TYPE, usage):
+    """get_owned_channel plus the channel status named by the first argument
+
+    Replies with the usage and the channel's statuses and returns (None, None, None) when
+    the argument is missing or unknown.
+    """
+    channel_id, config = await get_owned_channel(update)
+    if not channel_id:
+        return None, None, None
+    
+    names = [name for name, _ in config["statuses"]]
+    if not context.args or context.args[0] not in names:
+        await update.message.reply_text(f"Використання: {usage}\nСтатуси: {', '.join(names)}")
+        return None, None, None
+    return channel_id, config, context.args[0]
+
+async def set_waiting(update: Update, context: ContextTypes.DEFAULT_TYPE, action):
+    """Remember which photo the user is expected to send next; persisted and expired by StatePersistence"""
+    context.user_data["waiting_for"] = action
+    context.user_data["waiting_since"] = time.time()
+    await save_user_data(update, context)
+
+async def clear_waiting(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    waiting_for = context.user_data.pop("waiting_for", None)
+    context.user_data.pop("waiting_since", None)
+    await save_user_data(update, context)
+    return waiting_for
+
+async def save_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # With a shared store the user's next update may go to another worker
+    if context.application.persistence is not None:
+        await context.application.persistence.write_through(update.effective_user.id, context.user_data)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Команди:\n"
         "/set_channel <channel_id> - встановити канал для налаштування\n"
-        "/set_red - замінити всі зображення для 🔴\n"
-        "/set_green - замінити всі зображення для 🟢\n"
-        "/add_red - додати зображення до 🔴\n"
-        "/add_green - додати зображення до 🟢\n"
-        "/list_red - список зображень 🔴\n"
-        "/list_green - список зображень 🟢\n"
-        "/remove_red <номер> - видалити зображення 🔴\n"
-        "/remove_green <номер> - видалити зображення 🟢\n"
+        "/set <статус> - замінити всі зображення статусу\n"
+        "/add <статус> - додати зображення до статусу\n"
+        "/bulk <статус> - додати багато зображень альбомами\n"
+        "/done - завершити додавання альбомів\n"
+        "/list <статус> - список зображень статусу\n"
+        "/remove <статус> <номер> - видалити зображення\n"
+        "/add_status <назва> <емодзі> [фраза] - додати власний статус з правилом розпізнавання\n"
+        "/remove_status <назва> - видалити власний статус разом із зображеннями\n"
+        "/add_phrase <статус> <емодзі> [фраза] - додати власне правило розпізнавання\n"
+        "/phrases - список власних правил\n"
+        "/clear_phrases - видалити всі власні правила\n"
         "/status - перевірити налаштування\n"
         "/transfer <user_id> - передати права власності\n"
-        "/remove_channel - видалити налаштування каналу\n\n"
+        "/remove_channel - видалити налаштування каналу\n"
+        "/export - вивантажити налаштування всіх ваших каналів у файл\n"
+        "/import - завантажити налаштування каналів з файлу\n\n"
+        "Статуси red (🔴) і green (🟢) є в кожному каналі; /set_red, /add_green тощо теж працюють.\n"
         "Щоб дізнатися ID каналу, перешліть будь-яке повідомлення з каналу сюди."
     )
 
@@ -172,16 +128,16 @@ async def set_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_id = int(context.args[0])
         user_id = update.message.from_user.id
         
-        if not is_owner(channel_id, user_id):
+        config = await aget_channel_config(channel_id)
+        if config["owner_id"] not in (None, user_id):
             await update.message.reply_text("❌ Цей канал вже налаштований іншим користувачем")
             return
         
-        config = get_channel_config(channel_id)
         if config["owner_id"] is None:
-            set_channel_owner(channel_id, user_id)
+            await aset_channel_owner(channel_id, user_id, config["channel_username"], config["channel_title"])
         
         # Save to database instead of context
-        set_user_active_channel(user_id, channel_id)
+        await aset_user_active_channel(user_id, channel_id)
         
         # Build channel display name
         channel_display = f"{channel_id}"
@@ -194,173 +150,257 @@ async def set_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("❌ Невірний ID каналу")
 
-async def set_red(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
+async def set_images(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config, status = await get_owned_status(update, context, "/set <статус>")
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    await update.message.reply_text(f"Надішліть фото для {status_label(config, status)} (замінить всі існуючі)")
+    await set_waiting(update, context, f"set_{status}")
+
+async def add_images(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config, status = await get_owned_status(update, context, "/add <статус>")
+    if not channel_id:
         return
     
-    await update.message.reply_text("Надішліть фото для 🔴 (замінить всі існуючі)")
-    context.user_data["waiting_for"] = "set_red"
+    await update.message.reply_text(f"Надішліть фото для додавання до {status_label(config, status)}")
+    await set_waiting(update, context, f"add_{status}")
 
-async def set_green(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
+async def bulk_images(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config, status = await get_owned_status(update, context, "/bulk <статус>")
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    await update.message.reply_text(f"Надсилайте фото або альбоми для додавання до {status_label(config, status)}, потім /done")
+    await set_waiting(update, context, f"bulk_{status}")
+
+async def done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    waiting_for = await clear_waiting(update, context)
+    if waiting_for and waiting_for.startswith("bulk_"):
+        await update.message.reply_text("✅ Додавання завершено")
+    else:
+        await update.message.reply_text("Немає активного додавання")
+
+async def commit_album(key):
+    """Wait until the album stops growing, then store all its photos in one transaction"""
+    album = _albums[key]
+    while (delay := album["updated"] + ALBUM_DELAY - time.monotonic()) > 0:
+        await asyncio.sleep(delay)
+    del _albums[key]
+    
+    added, count = await aadd_channel_images(album["channel_id"], album["status"], album["images"])
+    skipped = len(album["images"]) - added
+    await album["message"].reply_text(
+        f"✅ Додано до {album['label']}: {added} (всього: {count})"
+        + (f"\nℹ️ Вже були в списку: {skipped}" if skipped else "")
+    )
+
+async def collect_bulk_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, status):
+    message = update.message
+    key = (update.effective_user.id, message.media_group_id or f"single:{message.message_id}")
+    album = _albums.get(key)
+    if album is None:
+        channel_id, config = await get_owned_channel(update)
+        if not channel_id or not await check_status_exists(update, context, config, status):
+            return
+        album = _albums[key] = {"channel_id": channel_id, "status": status, "label": status_label(config, status),
+                                "images": [], "message": message}
+        context.application.create_task(commit_album(key), update=update)
+    album["images"].append(photo_record(message.photo[-1]))
+    album["updated"] = time.monotonic()
+    # Keep an active bulk session from expiring while albums are still coming in
+    context.user_data["waiting_since"] = time.time()
+
+def image_tag(file_id):
+    """Short fingerprint of an image so stale inline buttons can be detected"""
+    return format(zlib.crc32(file_id.encode()), "x")
+
+async def send_image_page(message, config, status, page):
+    """Send one page of a status's images as an album, followed by remove and page buttons"""
+    emoji = status_label(config, status)
+    images = config["images"].get(status, [])
+    if not images:
+        await message.reply_text(f"{emoji} Немає зображень")
+        return
+    
+    pages = (len(images) + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE
+    page = min(page, pages - 1)
+    start = page * LIST_PAGE_SIZE
+    page_images = images[start:start + LIST_PAGE_SIZE]
+    
+    # Media groups need at least two items
+    if len(page_images) == 1:
+        await message.reply_photo(photo=page_images[0], caption=f"#{start + 1}")
+    else:
+        await message.reply_media_group(media=[
+            InputMediaPhoto(media=image_id, caption=f"#{i}")
+            for i, image_id in enumerate(page_images, start + 1)
+        ])
+    
+    remove_buttons = [
+        InlineKeyboardButton(f"🗑 #{i}", callback_data=f"img:rm:{status}:{i - 1}:{image_tag(image_id)}")
+        for i, image_id in enumerate(page_images, start + 1)
+    ]
+    keyboard = [remove_buttons[i:i + 5] for i in range(0, len(remove_buttons), 5)]
+    if pages > 1:
+        keyboard.append([
+            InlineKeyboardButton("◀️", callback_data=f"img:page:{status}:{(page - 1) % pages}"),
+            InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="img:noop"),
+            InlineKeyboardButton("▶️", callback_data=f"img:page:{status}:{(page + 1) % pages}"),
+        ])
+    await message.reply_text(
+        f"{emoji} Зображень: {len(images)}\n\nНатисніть 🗑 або використовуйте /remove {status} <номер> для видалення",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def list_images(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config, status = await get_owned_status(update, context, "/list <статус>")
+    if not channel_id:
         return
     
-    await update.message.reply_text("Надішліть фото для 🟢 (замінить всі існуючі)")
-    context.user_data["waiting_for"] = "set_green"
+    await send_image_page(update.message, config, status, 0)
 
-async def add_red(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
-    if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
+async def handle_list_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    parts = query.data.split(":")
+    if parts[1] == "noop":
+        await query.answer()
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    user_id = query.from_user.id
+    channel_id, config = await aget_session(user_id)
+    if not channel_id or config["owner_id"] not in (None, user_id):
+        await query.answer("❌ Ви не є власником цього каналу", show_alert=True)
         return
     
-    await update.message.reply_text("Надішліть фото для додавання до 🔴")
-    context.user_data["waiting_for"] = "add_red"
-
-async def add_green(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
+    status = parts[2]
+    images = config["images"].get(status, [])
+    if parts[1] == "page":
+        await query.answer()
+        await query.edit_message_reply_markup(reply_markup=None)
+        await send_image_page(query.message, config, status, int(parts[3]))
+        return
     
+    index, tag = int(parts[3]), parts[4]
+    if index >= len(images) or image_tag(images[index]) != tag:
+        await query.answer("Список змінився, ось актуальний", show_alert=True)
+    else:
+        await aremove_channel_image(channel_id, status, index)
+        await query.answer(f"✅ Видалено зображення #{index + 1}")
+        config = await aget_channel_config(channel_id)
+    # Numbers shift after a removal, so the page is sent again with fresh captions
+    await query.edit_message_reply_markup(reply_markup=None)
+    await send_image_page(query.message, config, status, index // LIST_PAGE_SIZE)
+
+async def remove_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config, status = await get_owned_status(update, context, "/remove <статус> <номер>")
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    if len(context.args) < 2:
+        await update.message.reply_text(f"Використання: /remove {status} <номер>")
         return
     
-    await update.message.reply_text("Надішліть фото для додавання до 🟢")
-    context.user_data["waiting_for"] = "add_green"
+    try:
+        index = int(context.args[1]) - 1
+        if not await aremove_channel_image(channel_id, status, index):
+            await update.message.reply_text("❌ Невірний номер зображення")
+            return
+        await update.message.reply_text(f"✅ Видалено зображення #{index+1} з {status_label(config, status)}")
+    except (ValueError, IndexError):
+        await update.message.reply_text("❌ Невірний номер зображення")
 
-async def list_red(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
+def for_status(callback, status, command):
+    """One of the old per-colour commands such as /set_red: the generic command with the status filled in"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        context.args = [status, *(context.args or [])]
+        return await callback(update, context)
+    # Handler metrics and trace spans are labelled by function name
+    wrapper.__name__ = command
+    return wrapper
+
+async def add_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config = await get_owned_channel(update)
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    if len(context.args) < 2 or not STATUS_NAME.match(context.args[0]):
+        await update.message.reply_text(
+            "Використання: /add_status <назва> <емодзі> [фраза]\n"
+            "Назва: латинські літери, цифри та _, до 16 символів"
+        )
         return
     
-    config = get_channel_config(channel_id)
-    if not config['red_images']:
-        await update.message.reply_text("🔴 Немає зображень")
+    name, trigger = context.args[0], context.args[1]
+    phrase = " ".join(context.args[2:])
+    if not await aadd_channel_status(channel_id, name, trigger):
+        await update.message.reply_text(f"❌ Статус {name} вже є")
         return
-    
-    await update.message.reply_text(f"🔴 Зображень: {len(config['red_images'])}\n\nВикористовуйте /remove_red <номер> для видалення")
-    
-    # Send each image with its number
-    for i, image_id in enumerate(config['red_images'], 1):
-        await update.message.reply_photo(photo=image_id, caption=f"#{i}")
+    await aadd_channel_rule(channel_id, name, trigger, phrase)
+    await update.message.reply_text(
+        f"✅ Додано статус {trigger} {name} з правилом: {trigger} {phrase}".rstrip()
+        + f"\nДодайте зображення: /add {name}"
+    )
 
-async def list_green(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
+async def remove_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config = await get_owned_channel(update)
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
-        return
-    
-    config = get_channel_config(channel_id)
-    if not config['green_images']:
-        await update.message.reply_text("🟢 Немає зображень")
+    if not context.args:
+        await update.message.reply_text("Використання: /remove_status <назва>")
         return
     
-    await update.message.reply_text(f"🟢 Зображень: {len(config['green_images'])}\n\nВикористовуйте /remove_green <номер> для видалення")
-    
-    # Send each image with its number
-    for i, image_id in enumerate(config['green_images'], 1):
-        await update.message.reply_photo(photo=image_id, caption=f"#{i}")
+    name = context.args[0]
+    if name in dict(BUILTIN_STATUSES):
+        await update.message.reply_text("❌ Вбудовані статуси не можна видалити")
+    elif not await aremove_channel_status(channel_id, name):
+        await update.message.reply_text(f"❌ Немає статусу {name}")
+    else:
+        await update.message.reply_text(f"✅ Статус {name} видалено разом із зображеннями та правилами")
 
-async def remove_red(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
+async def add_phrase(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config = await get_owned_channel(update)
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
-        return
-    
-    if not context.args:
-        await update.message.reply_text("Використання: /remove_red <номер>")
+    if len(context.args) < 2 or context.args[0] not in dict(config["statuses"]):
+        await update.message.reply_text(
+            "Використання: /add_phrase <статус> <емодзі> [фраза]\n"
+            f"Статуси: {', '.join(name for name, _ in config['statuses'])}"
+        )
         return
     
-    try:
-        index = int(context.args[0]) - 1
-        remove_channel_image(channel_id, "red", index)
-        await update.message.reply_text(f"✅ Видалено зображення #{index+1} з 🔴")
-    except (ValueError, IndexError):
-        await update.message.reply_text("❌ Невірний номер зображення")
+    status, trigger = context.args[0], context.args[1]
+    phrase = " ".join(context.args[2:])
+    await aadd_channel_rule(channel_id, status, trigger, phrase)
+    await update.message.reply_text(f"✅ Додано правило для {status_label(config, status)}: {trigger} {phrase}".rstrip())
 
-async def remove_green(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
+async def phrases(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config = await get_owned_channel(update)
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    if not config['rules']:
+        await update.message.reply_text("Власних правил немає")
         return
     
-    if not context.args:
-        await update.message.reply_text("Використання: /remove_green <номер>")
+    lines = [f"{status_label(config, status)} {trigger} {phrase}".rstrip() for status, trigger, phrase in config['rules']]
+    await update.message.reply_text("Власні правила:\n" + "\n".join(lines))
+
+async def clear_phrases(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    channel_id, config = await get_owned_channel(update)
+    if not channel_id:
         return
     
-    try:
-        index = int(context.args[0]) - 1
-        remove_channel_image(channel_id, "green", index)
-        await update.message.reply_text(f"✅ Видалено зображення #{index+1} з 🟢")
-    except (ValueError, IndexError):
-        await update.message.reply_text("❌ Невірний номер зображення")
-
+    await aclear_channel_rules(channel_id)
+    await update.message.reply_text("✅ Власні правила видалено")
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
+    channel_id, config = await get_owned_channel(update)
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
-        return
-    
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
         return
     
-    config = get_channel_config(channel_id)
-    
     # Build channel display name
     channel_display = f"{channel_id}"
     if config['channel_username']:
@@ -371,16 +411,13 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         f"Канал: {channel_display}\n"
         f"Власник: {config['owner_id']}\n"
-        f"🔴 зображень: {len(config['red_images'])}\n"
-        f"🟢 зображень: {len(config['green_images'])}"
+        + "\n".join(f"{label} {name} зображень: {len(config['images'][name])}" for name, label in config['statuses'])
+        + (f"\n⚠️ Недійсних зображень: {config['dead_images']} (Telegram більше не приймає їх)" if config['dead_images'] else "")
     )
 
 async def transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
+    channel_id, config = await get_owned_channel(update)
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
     if not context.args:
@@ -390,31 +427,67 @@ async def transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         new_owner_id = int(context.args[0])
         
-        if not is_owner(channel_id, user_id):
-            await update.message.reply_text("❌ Ви не є власником цього каналу")
-            return
-        
-        transfer_ownership(channel_id, new_owner_id)
+        await atransfer_ownership(channel_id, new_owner_id)
         
         await update.message.reply_text(f"✅ Права власності передано користувачу {new_owner_id}")
     except ValueError:
         await update.message.reply_text("❌ Невірний ID користувача")
 
 async def remove_channel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
-    
+    channel_id, config = await get_owned_channel(update)
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    await aremove_channel(channel_id)
+    
+    await update.message.reply_text(f"✅ Налаштування каналу {channel_id} видалено")
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    out = io.StringIO()
+    count = await aexport_channels(out, update.effective_user.id)
+    if not count:
+        await update.message.reply_text("У вас немає каналів")
+        return
+    
+    await update.message.reply_document(
+        document=out.getvalue().encode(), filename="channels.ndjson",
+        caption=f"✅ Каналів: {count}\nЩоб перенести їх, надішліть /import і цей файл"
+    )
+
+async def import_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Надішліть файл, створений командою /export")
+    await set_waiting(update, context, "import")
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get("waiting_for") != "import":
         return
+    await clear_waiting(update, context)
     
-    remove_channel(channel_id)
+    import tempfile
     
-    await update.message.reply_text(f"✅ Налаштування каналу {channel_id} видалено")
+    # Downloaded to disk and read line by line, so big exports are never held in memory
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "import.ndjson")
+        file = await update.message.document.get_file()
+        await file.download_to_drive(path)
+        try:
+            imported, skipped = await aimport_channels_file(path, update.effective_user.id)
+        except (ValueError, KeyError, TypeError) as exc:
+            await update.message.reply_text(f"❌ Невірний файл, нічого не змінено: {exc}")
+            return
+    
+    await update.message.reply_text(
+        f"✅ Імпортовано каналів: {imported}"
+        + (f"\n⚠️ Пропущено, бо мають іншого власника: {skipped}" if skipped else "")
+    )
+
+async def check_status_exists(update: Update, context: ContextTypes.DEFAULT_TYPE, config, status):
+    """False, with a reply, when the status a photo was meant for has been removed meanwhile"""
+    if status in config["images"]:
+        return True
+    await clear_waiting(update, context)
+    await update.message.reply_text(f"❌ Статусу {status} більше немає")
+    return False
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type != "private":
@@ -424,59 +497,96 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not waiting_for:
         return
     
-    user_id = update.message.from_user.id
-    channel_id = get_user_active_channel(user_id)
+    # "<action>_<status>", status names may contain underscores themselves
+    action, _, status = waiting_for.partition("_")
+    if action == "bulk":
+        await collect_bulk_photo(update, context, status)
+        return
+    if action == "import":
+        # Still waiting: the export has to arrive as a file, not as a picture
+        await update.message.reply_text("📎 Надішліть файл експорту як документ")
+        return
     
+    channel_id, config = await get_owned_channel(update)
     if not channel_id:
-        await update.message.reply_text("❌ Спочатку встановіть канал: /set_channel <channel_id>")
         return
     
     photo = update.message.photo[-1]
     
     # Handle different actions
-    if waiting_for in ["set_red", "set_green"]:
-        color = waiting_for.split("_")[1]
-        update_channel_image(channel_id, color, photo.file_id)
-        await update.message.reply_text(f"✅ Зображення для {'🔴' if color == 'red' else '🟢'} замінено")
-    elif waiting_for in ["add_red", "add_green"]:
-        color = waiting_for.split("_")[1]
-        add_channel_image(channel_id, color, photo.file_id)
-        config = get_channel_config(channel_id)
-        count = len(config['red_images']) if color == 'red' else len(config['green_images'])
-        await update.message.reply_text(f"✅ Додано зображення до {'🔴' if color == 'red' else '🟢'} (всього: {count})")
-    
-    context.user_data.pop("waiting_for")
+    if action == "set":
+        if await check_status_exists(update, context, config, status):
+            await aupdate_channel_image(channel_id, status, photo_record(photo))
+            await update.message.reply_text(f"✅ Зображення для {status_label(config, status)} замінено")
+    elif action == "add":
+        if await check_status_exists(update, context, config, status):
+            added, count = await aadd_channel_image(channel_id, status, photo_record(photo))
+            if added:
+                await update.message.reply_text(f"✅ Додано зображення до {status_label(config, status)} (всього: {count})")
+            else:
+                await update.message.reply_text(f"ℹ️ Це зображення вже є в {status_label(config, status)} (всього: {count})")
+    
+    await clear_waiting(update, context)
 
 async def handle_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.channel_post or not update.channel_post.text:
+    # Edits come back after the bot replaces the media, then the text is the caption
+    edited = update.edited_channel_post is not None
+    message = update.edited_channel_post if edited else update.channel_post
+    if not message:
+        return
+    text = message.text or (message.caption if edited else None)
+    if not text:
         return
     
-    text = update.channel_post.text
-    channel_id = update.channel_post.chat_id
-    config = get_channel_config(channel_id)
+    # Counted from arrival, so time spent queued behind the channel's earlier posts is included
+    received = received_at() or time.monotonic()
+    channel_id = message.chat_id
+    with span("config"):
+        config = await aget_channel_config(channel_id)
     
     # Update channel info if we have it
-    if update.channel_post.chat:
-        chat = update.channel_post.chat
+    if message.chat:
+        chat = message.chat
         username = chat.username if hasattr(chat, 'username') else None
         title = chat.title if hasattr(chat, 'title') else None
         if username or title:
-            update_channel_info(channel_id, username, title)
+            with span("channel_info"):
+                await aupdate_channel_info(channel_id, username, title)
     
-    if re.search(r"🔴.*світло зникло", text, re.IGNORECASE):
-        images = config.get("red_images", [])
-    elif re.search(r"🟢.*світло з'явилося", text, re.IGNORECASE):
-        images = config.get("green_images", [])
-    else:
+    classify_start = time.perf_counter()
+    with span("classify"):
+        classifier = get_classifier(config["rules"], config["statuses"])
+        post_status = classifier.classify(text)
+    CLASSIFY_SECONDS.observe(time.perf_counter() - classify_start)
+    if not recent_posts.record(channel_id, message.message_id, post_status, edited):
+        return
+    if post_status is None:
+        return
+    images = config["images"][post_status]
+    # During a flap only the newest post gets an image, older ones would be stale anyway
+    if recent_posts.superseded(channel_id, message.message_id, classifier.classify,
+                               lambda status: bool(config["images"].get(status))):
         return
     
-    if images:
-        # Randomly select one image
-        image_id = random.choice(images)
-        from telegram import InputMediaPhoto
-        await update.channel_post.edit_media(
-            media=InputMediaPhoto(media=image_id, caption=text)
-        )
+    # Shuffled rotation, no image repeats until every one has been used
+    image_id = draw_image(channel_id, post_status, images, context.chat_data)
+    if not image_id:
+        return
+    try:
+        with span("edit_media", status=post_status):
+            await message.edit_media(media=InputMediaPhoto(media=image_id, caption=text))
+    except BadRequest as exc:
+        if not is_bad_file(exc):
+            raise
+        # Flag the image so no post tries it again, then retry once with the next one
+        await amark_image_dead(image_id)
+        images = (await aget_channel_config(channel_id))["images"].get(post_status, [])
+        image_id = draw_image(channel_id, post_status, images, context.chat_data)
+        if not image_id:
+            return
+        with span("edit_media", status=post_status, retry=True):
+            await message.edit_media(media=InputMediaPhoto(media=image_id, caption=text))
+    POST_EDIT_SECONDS.observe(time.monotonic() - received, status=post_status)
 
 async def handle_forwarded(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
@@ -514,52 +624,144 @@ async def handle_forwarded(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Використайте: /set_channel {channel_id}"
             )
 
+async def on_shutdown(app: Application):
+    await stop_web_server()
+    await shutdown_db()
+
+async def run(app: Application, webhook_mode):
+    """Answer health checks first, then bring up storage and Telegram, until SIGINT/SIGTERM
+
+    In webhook mode the same aiohttp server also receives Telegram updates.
+    """
+    webhook_url = os.getenv("WEBHOOK_URL")
+    webhook_path = os.getenv("WEBHOOK_PATH", "/telegram") if webhook_mode else None
+    secret_token = os.getenv("WEBHOOK_SECRET")
+    
+    # A cold host is only marked live once the port answers, so that comes before any
+    # database work or Telegram round trip
+    await start_web_server(create_web_app(app, webhook_path, secret_token), int(os.getenv("PORT", 10000)))
+    boot.mark("health server")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await ainit_db()
+        boot.mark("storage")
+        await app.initialize()
+        boot.mark("telegram init")
+        if not webhook_mode:
+            await app.updater.start_polling()
+        elif webhook_url:
+            # Without WEBHOOK_URL the server only accepts updates POSTed to it locally
+            await app.bot.set_webhook(webhook_url.rstrip("/") + webhook_path, secret_token=secret_token)
+        await app.start()
+        boot.mark("telegram start")
+        print(boot.report(), file=sys.stderr, flush=True)
+        await stop.wait()
+    finally:
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await on_shutdown(app)
+
+def handler(callback):
+    """Metrics for every handler, plus a root span for sampled updates when tracing is on"""
+    return timed_handler(traced_handler(callback))
+
+def add_handlers(app: Application):
+    app.add_handler(CommandHandler("start", handler(start)))
+    app.add_handler(CommandHandler("set_channel", handler(set_channel)))
+    app.add_handler(CommandHandler("set", handler(set_images)))
+    app.add_handler(CommandHandler("add", handler(add_images)))
+    app.add_handler(CommandHandler("bulk", handler(bulk_images)))
+    app.add_handler(CommandHandler("done", handler(done)))
+    app.add_handler(CommandHandler("list", handler(list_images)))
+    app.add_handler(CallbackQueryHandler(handler(handle_list_button), pattern=r"^img:"))
+    app.add_handler(CommandHandler("remove", handler(remove_image)))
+    # /set_red, /add_green and the rest from before statuses were configurable
+    for builtin, _ in BUILTIN_STATUSES:
+        for command, callback in (("set", set_images), ("add", add_images), ("bulk", bulk_images),
+                                  ("list", list_images), ("remove", remove_image)):
+            name = f"{command}_{builtin}"
+            app.add_handler(CommandHandler(name, handler(for_status(callback, builtin, name))))
+    app.add_handler(CommandHandler("add_status", handler(add_status)))
+    app.add_handler(CommandHandler("remove_status", handler(remove_status)))
+    app.add_handler(CommandHandler("add_phrase", handler(add_phrase)))
+    app.add_handler(CommandHandler("phrases", handler(phrases)))
+    app.add_handler(CommandHandler("clear_phrases", handler(clear_phrases)))
+    app.add_handler(CommandHandler("status", handler(status)))
+    app.add_handler(CommandHandler("transfer", handler(transfer)))
+    app.add_handler(CommandHandler("remove_channel", handler(remove_channel_cmd)))
+    app.add_handler(CommandHandler("export", handler(export_cmd)))
+    app.add_handler(CommandHandler("import", handler(import_cmd)))
+    app.add_handler(MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, handler(handle_photo)))
+    app.add_handler(MessageHandler(filters.FORWARDED & filters.ChatType.PRIVATE, handler(handle_forwarded)))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.ChatType.PRIVATE, handler(handle_document)))
+    app.add_handler(MessageHandler(filters.ChatType.CHANNEL, handler(handle_channel_post)))
+
+def run_cli(argv):
+    """`python bot.py export|import [file]`: move channel configs between hosts without Telegram"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog="bot.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write all channels as NDJSON")
+    export_parser.add_argument("file", nargs="?", default="-", help="output file, - for stdout")
+    export_parser.add_argument("--owner", type=int, help="only the channels of this user")
+    import_parser = commands.add_parser("import", help="load channels from an export in one transaction")
+    import_parser.add_argument("file", nargs="?", default="-", help="input file, - for stdin")
+    import_parser.add_argument("--owner", type=int, help="import for this user, skipping channels someone else owns")
+    args = parser.parse_args(argv)
+    
+    init_storage()
+    if args.command == "export":
+        count = export_channels_file(args.file, args.owner)
+        print(f"Exported {count} channels", file=sys.stderr)
+    else:
+        imported, skipped = import_channels_file(args.file, args.owner)
+        print(f"Imported {imported} channels, skipped {skipped}", file=sys.stderr)
+
 def main():
-    init_db()
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+        return
     
     # Try environment variable first, then token.txt
-    import os
     token = os.getenv("BOT_TOKEN")
     if not token:
         with open("token.txt") as f:
             token = f.read().strip()
     
-    app = Application.builder().token(token).build()
-    
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("set_channel", set_channel))
-    app.add_handler(CommandHandler("set_red", set_red))
-    app.add_handler(CommandHandler("set_green", set_green))
-    app.add_handler(CommandHandler("add_red", add_red))
-    app.add_handler(CommandHandler("add_green", add_green))
-    app.add_handler(CommandHandler("list_red", list_red))
-    app.add_handler(CommandHandler("list_green", list_green))
-    app.add_handler(CommandHandler("remove_red", remove_red))
-    app.add_handler(CommandHandler("remove_green", remove_green))
-    app.add_handler(CommandHandler("status", status))
-    app.add_handler(CommandHandler("transfer", transfer))
-    app.add_handler(CommandHandler("remove_channel", remove_channel_cmd))
-    app.add_handler(MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, handle_photo))
-    app.add_handler(MessageHandler(filters.FORWARDED & filters.ChatType.PRIVATE, handle_forwarded))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL, handle_channel_post))
-    
-    # Start health check server for Render
-    import threading
-    from http.server import HTTPServer, BaseHTTPRequestHandler
-    
-    class HealthHandler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"Bot is running")
-        def log_message(self, format, *args):
-            pass  # Suppress logs
-    
-    port = int(os.getenv("PORT", 10000))
-    server = HTTPServer(("0.0.0.0", port), HealthHandler)
-    threading.Thread(target=server.serve_forever, daemon=True).start()
-    
-    app.run_polling()
+    builder = Application.builder().token(token).rate_limiter(PriorityRateLimiter())
+    # Pending /set and /add states are flushed to the store in batches and survive restarts
+    builder = builder.persistence(StatePersistence(
+        update_interval=int(os.getenv("PERSISTENCE_INTERVAL", 60)),
+        waiting_ttl=int(os.getenv("WAITING_TTL", 3600)),
+    ))
+    # Updates for different channels/users run concurrently, each channel or user stays in order
+    concurrent_updates = int(os.getenv("CONCURRENT_UPDATES", 8))
+    if concurrent_updates > 1:
+        builder = builder.concurrent_updates(KeyedUpdateProcessor(concurrent_updates, on_arrival=recent_posts.arrived))
+    app = builder.build()
+    
+    add_handlers(app)
+    # Re-check a bounded batch of stored file_ids every interval so dead ones are skipped by posts
+    verify_batch = int(os.getenv("MEDIA_VERIFY_BATCH", 20))
+    if verify_batch > 0:
+        app.job_queue.run_repeating(verify_media, interval=int(os.getenv("MEDIA_VERIFY_INTERVAL", 3600)),
+                                    first=60, data=verify_batch, name="verify_media")
+    # Orphan cleanup, vacuum, WAL checkpoint and table stats, each within a time budget and only while idle
+    maintenance_interval = int(os.getenv("MAINTENANCE_INTERVAL", 3600))
+    if maintenance_interval > 0:
+        app.job_queue.run_repeating(run_maintenance, interval=maintenance_interval, first=300,
+                                    data=float(os.getenv("MAINTENANCE_BUDGET", 1.0)), name="maintenance")
+    
+    boot.mark("build")
+    
+    asyncio.run(run(app, os.getenv("BOT_MODE", "polling") == "webhook"))
 
 if __name__ == "__main__":
     main()
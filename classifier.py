@@ -0,0 +1,100 @@
+import re
+from functools import lru_cache
+
+# (name, label) of the statuses every channel has, in priority order; channels can add
+# their own after these, see /add_status
+BUILTIN_STATUSES = (("red", "🔴"), ("green", "🟢"))
+# Status names end up in callback data and command arguments, so they stay short and plain
+STATUS_NAME = re.compile(r"^[a-z0-9_]{1,16}$")
+
+# (status, trigger emoji, phrase) matched like the original `🔴.*світло зникло`:
+# the phrase has to follow the trigger on the same line, case-insensitively
+DEFAULT_RULES = (
+    ("red", "🔴", "світло зникло"),
+    ("green", "🟢", "світло з'явилося"),
+)
+
+class StatusClassifier:
+    """Precompiled matcher that only runs a regex where one of its triggers occurs
+
+    Rules are grouped by trigger, so a post costs one str.find scan per distinct trigger.
+    The cost grows linearly with the distinct triggers of the channel, not with the statuses
+    or phrases sharing them. A single regex over all triggers would do one pass, but it is
+    slower than these C-speed finds even at 16 triggers.
+    """
+
+    def __init__(self, rules, statuses=BUILTIN_STATUSES):
+        self.statuses = tuple(name for name, _ in statuses)
+        # Rules of statuses the channel no longer has are ignored. Stable sort by priority
+        # so that at equal positions the higher-priority rule wins
+        self.rules = tuple(sorted((rule for rule in rules if rule[0] in self.statuses),
+                                  key=lambda rule: self.statuses.index(rule[0])))
+        self._by_trigger = []
+        for trigger in dict.fromkeys(trigger for _, trigger, _ in self.rules):
+            rules = [rule for rule in self.rules if rule[1] == trigger]
+            pattern = re.compile("|".join(
+                f"({re.escape(trigger)}[^\n]*?{re.escape(phrase)})" for _, _, phrase in rules
+            ), re.IGNORECASE)
+            # Indexed by match.lastindex, group 0 is never the last matched group
+            ranks = [None] + [self.statuses.index(status) for status, _, _ in rules]
+            self._by_trigger.append((trigger, pattern, ranks))
+
+    def classify(self, text):
+        """Return the matched status name or None"""
+        best = None
+        for trigger, pattern, ranks in self._by_trigger:
+            # str.find skips ahead at C speed; a regex alternation of the triggers, or a
+            # character class of their first characters, scans 10-100x slower
+            start = text.find(trigger)
+            while start != -1:
+                match = pattern.match(text, start)
+                if match is not None:
+                    rank = ranks[match.lastindex]
+                    if best is None or rank < best:
+                        best = rank
+                    if rank == ranks[1]:
+                        break
+                start = text.find(trigger, start + 1)
+            if best == 0:
+                break
+        return self.statuses[best] if best is not None else None
+
+@lru_cache(maxsize=1024)
+def get_classifier(extra_rules=(), statuses=BUILTIN_STATUSES):
+    """Classifier for the default rules plus a channel's own, built once per distinct rule set
+
+    `statuses` are the channel's (name, label) pairs in priority order.
+    """
+    return StatusClassifier(DEFAULT_RULES + tuple(extra_rules), statuses)
+
+def _benchmark():
+    import timeit
+
+    posts = [
+        "🔴 17:42 світло зникло\nНаступне ввімкнення за графіком о 21:00",
+        "🟢 21:03 Світло з'явилося\nСвітло було відсутнє 3 год 21 хв",
+        "🔴 Увага! Оновлено графік стабілізаційних відключень\n" + "Черга 2.2: 14:00-18:00\n" * 12,
+        "Графік погодинних відключень на завтра:\n" + "Черга 1.1: 00:00-04:00, 08:00-12:00\n" * 30,
+        "Оновлення від обленерго: у зв'язку з аварійною ситуацією можливі відхилення від графіку. " * 40,
+    ]
+    legacy_red = r"🔴.*світло зникло"
+    legacy_green = r"🟢.*світло з'явилося"
+
+    def legacy(text):
+        if re.search(legacy_red, text, re.IGNORECASE):
+            return "red"
+        if re.search(legacy_green, text, re.IGNORECASE):
+            return "green"
+        return None
+
+    classifier = get_classifier()
+    number = 20000
+    for text in posts:
+        assert legacy(text) == classifier.classify(text)
+        label = text.splitlines()[0][:40]
+        old = timeit.timeit(lambda: legacy(text), number=number)
+        new = timeit.timeit(lambda: classifier.classify(text), number=number)
+        print(f"{label!r:45} {len(text):6} chars  legacy {number / old:>10.0f}/s  classifier {number / new:>10.0f}/s")
+
+if __name__ == "__main__":
+    _benchmark()
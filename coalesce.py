@@ -0,0 +1,100 @@
+import time
+from collections import OrderedDict
+from metrics import Counter
+
+POSTS_SKIPPED = Counter("bot_channel_posts_skipped_total", "Channel posts left without an image edit, per reason")
+
+# Status of a post that arrived but has not been classified by its handler yet
+_PENDING = object()
+
+class PostWindow:
+    """Recent posts of each channel, to drop duplicate deliveries and coalesce status flaps
+
+    Every post is remembered for `window` seconds with its status. A post delivered again with
+    the same status (a repeated update, or the edited_channel_post Telegram sends after the bot
+    itself replaced the media) is skipped. A status post that is followed within
+    `flap_window` seconds by a newer status post is superseded: updates of one channel are
+    handled in order, so by the time the old post reaches edit_media the newer one is already
+    queued, and only the newest post spends a Bot API call.
+
+    Arrivals are recorded by KeyedUpdateProcessor through arrived(); without it (sequential
+    processing) only duplicates are detected.
+    """
+
+    def __init__(self, window=300, flap_window=10):
+        self.window = window
+        self.flap_window = flap_window
+        # channel_id -> OrderedDict message_id -> [arrived at, status or _PENDING, text until handled]
+        self._channels = {}
+        self._swept = time.monotonic()
+
+    def _prune(self, posts, now):
+        while posts and next(iter(posts.values()))[0] < now - self.window:
+            posts.popitem(last=False)
+
+    def _posts(self, channel_id, now):
+        # Channels that went quiet are only pruned here, once a window, and dropped when empty
+        if now - self._swept >= self.window:
+            self._swept = now
+            for quiet_id, posts in list(self._channels.items()):
+                self._prune(posts, now)
+                if not posts:
+                    del self._channels[quiet_id]
+        posts = self._channels.get(channel_id)
+        if posts is None:
+            posts = self._channels[channel_id] = OrderedDict()
+        self._prune(posts, now)
+        return posts
+
+    def arrived(self, update):
+        """Note a new channel post as soon as it is received, before it waits for its turn"""
+        message = update.channel_post
+        if message is None or not message.text:
+            return
+        posts = self._posts(message.chat_id, time.monotonic())
+        posts.setdefault(message.message_id, [time.monotonic(), _PENDING, message.text])
+
+    def record(self, channel_id, message_id, status, edited=False):
+        """Store the status of a classified post; False when it needs no further handling
+
+        That is the case for a post already handled with this status, and for edits of
+        posts too old to be remembered, which are left alone as before.
+        """
+        now = time.monotonic()
+        posts = self._posts(channel_id, now)
+        entry = posts.get(message_id)
+        if entry is None:
+            if edited:
+                return False
+            posts[message_id] = [now, status, None]
+            return True
+        if entry[2] is None and entry[1] == status:
+            POSTS_SKIPPED.inc(reason="duplicate")
+            return False
+        entry[1], entry[2] = status, None
+        return True
+
+    def superseded(self, channel_id, message_id, classify, has_images):
+        """Whether a newer status post arrived within flap_window of this one
+
+        `classify` maps the text of a post that is still queued to its status. Only a newer
+        post whose status `has_images` counts, any other one will not be edited either.
+        """
+        if not self.flap_window:
+            return False
+        posts = self._channels.get(channel_id)
+        entry = posts and posts.get(message_id)
+        if not entry:
+            return False
+        for newer_id, newer in reversed(posts.items()):
+            if newer[0] > entry[0] + self.flap_window or newer_id <= message_id:
+                continue
+            if newer[1] is _PENDING:
+                newer[1] = classify(newer[2])
+            if newer[1] is not None and has_images(newer[1]):
+                POSTS_SKIPPED.inc(reason="superseded")
+                return True
+        return False
+
+    def clear(self):
+        self._channels.clear()
@@ -19,6 +19,11 @@ echo "==> Creating token file..."
 read -p "Enter your bot token: " BOT_TOKEN
 echo "$BOT_TOKEN" > token.txt
 
+if [ -f ~/channels.ndjson ]; then
+    echo "==> Importing channels from ~/channels.ndjson..."
+    python3 bot.py import ~/channels.ndjson
+fi
+
 echo "==> Creating systemd service..."
 sudo tee /etc/systemd/system/telegram-bot.service > /dev/null <<EOF
 [Unit]
@@ -0,0 +1,135 @@
+import time
+import asyncio
+import contextlib
+import contextvars
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from metrics import register_collector
+
+# time.monotonic() when the update being handled reached the processor
+_received_at = contextvars.ContextVar("received_at", default=None)
+
+def received_at():
+    """When the current update arrived, before any queueing; None without KeyedUpdateProcessor"""
+    return _received_at.get()
+
+def update_key(update):
+    """Ordering key: the channel for channel posts, the sender for everything else"""
+    if not isinstance(update, Update):
+        return None
+    chat = update.effective_chat
+    if chat is not None and chat.type == "channel":
+        return f"channel:{chat.id}"
+    if update.effective_user is not None:
+        return f"user:{update.effective_user.id}"
+    if chat is not None:
+        return f"chat:{chat.id}"
+    return None
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping updates with the same key strictly in order
+
+    PTB holds its own semaphore for the whole of do_process_update, so that one is sized by
+    max_pending_updates and only bounds how many updates may wait. The real concurrency cap is
+    taken after the per-key lock, so a burst in one channel cannot occupy every slot while
+    waiting for its own turn.
+
+    `on_arrival`, if given, is called with each update as it comes in, before it waits.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates=10000, on_arrival=None):
+        super().__init__(max_pending_updates)
+        self.on_arrival = on_arrival
+        self.concurrency = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # key -> [lock, number of updates holding or waiting for it]
+        self._keys = {}
+        self.pending = 0
+        self.active = 0
+        # Kind of ordering key ("channel", "user", "chat", "other") -> [updates processed,
+        # total seconds waited, longest wait]. Per kind rather than per key, so the metrics stay
+        # a handful of series however many chats there are, and carry no user ids
+        self.waits = {}
+        register_collector(self._collect)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _acquire_key(self, key):
+        if key is None:
+            return contextlib.nullcontext()
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = self._keys[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_key(self, key):
+        if key is None:
+            return
+        entry = self._keys[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._keys[key]
+
+    def _record_wait(self, key, waited):
+        kind = key.split(":", 1)[0] if key else "other"
+        stats = self.waits.get(kind)
+        if stats is None:
+            stats = self.waits[kind] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        # Each update runs in its own task, so the handler awaited below sees this value
+        _received_at.set(time.monotonic())
+        if self.on_arrival is not None and isinstance(update, Update):
+            self.on_arrival(update)
+        # Lock is FIFO and nothing is awaited before acquire(), so arrival order is kept per key
+        lock = self._acquire_key(key)
+        queued_at = time.monotonic()
+        self.pending += 1
+        started = False
+        try:
+            async with lock, self._slots:
+                started = True
+                self.pending -= 1
+                self._record_wait(key, time.monotonic() - queued_at)
+                self.active += 1
+                try:
+                    await coroutine
+                finally:
+                    self.active -= 1
+        finally:
+            if not started:
+                self.pending -= 1
+            self._release_key(key)
+
+    def stats(self):
+        """Queue depth and wait times per kind of key for the metrics endpoint"""
+        return {
+            "pending": self.pending,
+            "active": self.active,
+            "keys": len(self._keys),
+            "waits": {kind: {"count": count, "total": total, "max": longest}
+                      for kind, (count, total, longest) in self.waits.items()},
+        }
+
+    def _collect(self):
+        stats = self.stats()
+        waits = stats["waits"].items()
+        return [
+            ("bot_updates_pending", "gauge", "Updates waiting for their key or a processing slot", [({}, stats["pending"])]),
+            ("bot_updates_active", "gauge", "Updates being processed", [({}, stats["active"])]),
+            ("bot_update_wait_seconds_total", "counter", "Time updates spent queued, per kind of ordering key",
+             [({"kind": kind}, wait["total"]) for kind, wait in waits]),
+            ("bot_update_wait_count_total", "counter", "Updates processed, per kind of ordering key",
+             [({"kind": kind}, wait["count"]) for kind, wait in waits]),
+            ("bot_update_wait_seconds_max", "gauge", "Longest time an update waited, per kind of ordering key",
+             [({"kind": kind}, wait["max"]) for kind, wait in waits]),
+        ]
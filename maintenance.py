@@ -0,0 +1,72 @@
+import time
+import logging
+from telegram.ext import ContextTypes
+from metrics import Counter, Histogram, register_collector
+from storage import aprune_orphans, aincremental_vacuum, awal_checkpoint, atable_stats
+
+MAINTENANCE_SECONDS = Histogram("bot_maintenance_task_seconds", "Time spent in each background maintenance task")
+MAINTENANCE_ROWS = Counter("bot_maintenance_pruned_rows_total", "Orphaned rows deleted by maintenance")
+MAINTENANCE_DEFERRED = Counter("bot_maintenance_deferred_total", "Maintenance tasks cut short by their budget or by incoming updates")
+
+# Rows deleted or pages freed per storage call; small enough that a queued update never waits long
+PRUNE_CHUNK = 500
+VACUUM_CHUNK = 256
+
+logger = logging.getLogger(__name__)
+
+_stats = {}
+
+@register_collector
+def _table_metrics():
+    return [("bot_storage_stat", "gauge", "Row counts and page usage of the store, from the last maintenance run",
+             [({"stat": name}, value) for name, value in _stats.items()])]
+
+def _busy(application):
+    processor = application.update_processor
+    return getattr(processor, "pending", 0) + getattr(processor, "active", 0) > 0
+
+async def _prune_orphans():
+    deleted, more = await aprune_orphans(PRUNE_CHUNK)
+    MAINTENANCE_ROWS.inc(deleted)
+    return not more
+
+async def _incremental_vacuum():
+    return not await aincremental_vacuum(VACUUM_CHUNK)
+
+async def _wal_checkpoint():
+    await awal_checkpoint()
+    return True
+
+async def _table_stats():
+    _stats.update(await atable_stats())
+    return True
+
+# Each step does one bounded chunk of work and returns True once the task is finished
+TASKS = (
+    ("prune_orphans", _prune_orphans),
+    ("incremental_vacuum", _incremental_vacuum),
+    ("wal_checkpoint", _wal_checkpoint),
+    ("table_stats", _table_stats),
+)
+
+async def run_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue callback running every maintenance task within job.data seconds each
+
+    Work goes to the storage thread in small chunks, so updates queued behind it wait for one
+    chunk at most. A task stops when its budget is used up or when updates are being
+    processed, and simply continues on the next run.
+    """
+    budget = context.job.data
+    for name, step in TASKS:
+        started = time.perf_counter()
+        try:
+            while True:
+                if _busy(context.application) or time.perf_counter() - started > budget:
+                    MAINTENANCE_DEFERRED.inc(task=name)
+                    break
+                if await step():
+                    break
+        except Exception:
+            logger.exception("Maintenance task %s failed", name)
+        finally:
+            MAINTENANCE_SECONDS.observe(time.perf_counter() - started, task=name)
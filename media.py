@@ -0,0 +1,57 @@
+import logging
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import ContextTypes
+from metrics import Counter
+from ratelimit import PRIORITY_BACKGROUND
+from storage import aimages_to_verify, arecord_verification
+
+MEDIA_CHECKS = Counter("bot_media_checks_total", "Stored file_ids re-validated with getFile, per result")
+
+logger = logging.getLogger(__name__)
+
+def photo_record(photo):
+    """Registry row for one size of a Telegram photo, as storage expects it"""
+    return (photo.file_id, photo.file_unique_id, photo.width, photo.height, photo.file_size)
+
+# How Bot API 400s phrase an unusable file_id: "Wrong file identifier/http url specified"
+# from sendPhoto/editMessageMedia, "Invalid file_id" and "Wrong file_id or the file is
+# temporarily unavailable" from getFile
+BAD_FILE_MESSAGES = ("file identifier", "file_id")
+
+def is_bad_file(exc):
+    """Whether a BadRequest says the file_id itself is unusable"""
+    message = exc.message.lower()
+    return any(text in message for text in BAD_FILE_MESSAGES)
+
+async def verify_media(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue callback checking the least recently verified file_ids with getFile
+
+    Each run checks at most job.data ids, so the bot spends a bounded number of API calls on
+    this no matter how many images are stored. Dead ids are flagged in the registry and
+    left out of channel configs; ids that work again are restored.
+    """
+    rate_limit_args = PRIORITY_BACKGROUND if context.bot.rate_limiter else None
+    results = []
+    for file_id in await aimages_to_verify(context.job.data):
+        try:
+            file = await context.bot.get_file(file_id, rate_limit_args=rate_limit_args)
+        except BadRequest as exc:
+            if not is_bad_file(exc):
+                # Still stamped as checked, or the id would stay at the front of every batch
+                logger.warning("Could not verify %s: %s", file_id, exc)
+                MEDIA_CHECKS.inc(result="unknown")
+                results.append((file_id, None, None, None))
+                continue
+            MEDIA_CHECKS.inc(result="dead")
+            results.append((file_id, False, None, None))
+        except TelegramError as exc:
+            # Network trouble or flood control, try the rest next time
+            logger.warning("Media verification interrupted: %s", exc)
+            break
+        else:
+            MEDIA_CHECKS.inc(result="ok")
+            results.append((file_id, True, file.file_unique_id, file.file_size))
+    if results:
+        changed = await arecord_verification(results)
+        if changed:
+            logger.info("Media verification changed usable images in %d channels", changed)
@@ -0,0 +1,153 @@
+import time
+import functools
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+_metrics = []
+_collectors = []
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, counts in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key + (("le", bound),), count))
+                samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), counts[-2]))
+                samples.append((f"{self.name}_count", key, counts[-2]))
+                samples.append((f"{self.name}_sum", key, counts[-1]))
+        return samples
+
+def register_collector(func):
+    """Add a callable returning (name, type, help, [(labels dict, value), ...]) tuples
+
+    Collectors are read at scrape time, for numbers other modules already keep themselves.
+    """
+    _collectors.append(func)
+    return func
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    for collector in _collectors:
+        for name, type, help, samples in collector():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+    return "\n".join(lines) + "\n"
+
+HANDLER_SECONDS = Histogram("bot_handler_duration_seconds", "Time spent in each update handler")
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceptions raised by update handlers")
+POST_EDIT_SECONDS = Histogram("bot_channel_post_edit_seconds", "Time from receiving a channel post to its image edit completing")
+CLASSIFY_SECONDS = Histogram("bot_classify_seconds", "Time spent classifying a channel post", DB_BUCKETS)
+DB_SECONDS = Histogram("bot_db_query_seconds", "Time spent in each storage helper", DB_BUCKETS)
+
+class BootTimer:
+    """Wall time of each startup phase, reported once and exposed as bot_boot_phase_seconds"""
+
+    def __init__(self, started=None):
+        self.started = self.last = time.perf_counter() if started is None else started
+        self.phases = []
+        register_collector(lambda: [
+            ("bot_boot_phase_seconds", "gauge", "Time each startup phase took",
+             [({"phase": phase}, seconds) for phase, seconds in self.phases]),
+        ])
+
+    def mark(self, phase):
+        """End the current phase under this name"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        lines = [f"{phase:>16} {seconds * 1000:8.1f} ms" for phase, seconds in self.phases]
+        lines.append(f"{'total':>16} {(self.last - self.started) * 1000:8.1f} ms")
+        return "Boot time:\n" + "\n".join(lines)
+
+def timed_handler(callback):
+    """Wrap a PTB handler callback to record its calls, duration and errors"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+    return wrapper
+
+def timed_query(func):
+    """Record how long a blocking storage helper takes"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, query=name)
+    return wrapper
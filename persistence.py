@@ -0,0 +1,129 @@
+import json
+import time
+import asyncio
+from telegram.ext import BasePersistence, PersistenceInput
+from storage import SHARED, aload_bot_state, aload_bot_state_entry, asave_bot_state
+
+class StatePersistence(BasePersistence):
+    """Keeps PTB user_data and chat_data in the store so pending uploads survive restarts
+
+    The application hands over changed entries every update_interval seconds. They are
+    buffered and written in one transaction per run, and entries whose JSON did not change
+    since the last write are skipped, so steady state costs no disk writes at all.
+    A waiting state older than waiting_ttl seconds is dropped on load and before each update.
+
+    With a shared store another worker may handle a user's next update, so user_data is
+    re-read before every update and handlers save changes right away with write_through().
+    """
+
+    def __init__(self, update_interval=60, waiting_ttl=3600):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.waiting_ttl = waiting_ttl
+        self.shared = SHARED
+        # (kind, key) -> JSON as last written, to skip unchanged entries
+        self._written = {}
+        # (kind, key) -> JSON to write or None to delete
+        self._pending = {}
+        self._flush_task = None
+
+    def _expire_waiting(self, data, now):
+        since = data.get("waiting_since")
+        if since is not None and now - since > self.waiting_ttl:
+            data.pop("waiting_for", None)
+            data.pop("waiting_since", None)
+
+    async def _load(self, kind):
+        now = time.time()
+        result = {}
+        for key, raw, _ in await aload_bot_state(kind):
+            self._written[(kind, key)] = raw
+            data = json.loads(raw)
+            self._expire_waiting(data, now)
+            result[key] = data
+        return result
+
+    def _queue(self, kind, key, data):
+        raw = json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+        if self._written.get((kind, key)) == raw:
+            self._pending.pop((kind, key), None)
+            return
+        self._pending[(kind, key)] = raw
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_batch())
+
+    async def _flush_after_batch(self):
+        # update_persistence() gathers all update_* calls, let the whole batch queue first
+        await asyncio.sleep(0)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        changes, self._pending = self._pending, {}
+        await asave_bot_state(changes)
+        for key, raw in changes.items():
+            if raw is None:
+                self._written.pop(key, None)
+            else:
+                self._written[key] = raw
+
+    async def get_user_data(self):
+        return await self._load("user")
+
+    async def get_chat_data(self):
+        return await self._load("chat")
+
+    async def update_user_data(self, user_id, data):
+        self._queue("user", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._queue("chat", chat_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._queue("user", user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._queue("chat", chat_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        if self.shared:
+            raw = await aload_bot_state_entry("user", user_id)
+            self._written[("user", user_id)] = raw
+            user_data.clear()
+            if raw:
+                user_data.update(json.loads(raw))
+        self._expire_waiting(user_data, time.time())
+
+    async def write_through(self, user_id, data):
+        """Store a user's data now when workers share the store; otherwise the next batch does it"""
+        if self.shared:
+            self._queue("user", user_id, data)
+            await self.flush()
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    # bot_data, callback data and conversations are not used by this bot
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
@@ -0,0 +1,72 @@
+"""Image rows and the NDJSON export format, shared by the SQLite and Redis storage backends"""
+import json
+from classifier import BUILTIN_STATUSES, STATUS_NAME
+
+# First line of an export; version only changes when old files can no longer be read
+EXPORT_HEADER = {"format": "tg_bot_image", "version": 1}
+
+def image_row(image):
+    # (file_id, file_unique_id, width, height, file_size), or a bare file_id when nothing else is known
+    return (image, None, None, None, None) if isinstance(image, str) else tuple(image)
+
+def dump_line(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+def check_header(record):
+    if record.get("format") != EXPORT_HEADER["format"] or record.get("version", 0) > EXPORT_HEADER["version"]:
+        raise ValueError(f"unsupported export format {record.get('format')!r} version {record.get('version')!r}")
+
+def check_channel(record):
+    """The channel id of an imported channel line, after checking the fields written as they are"""
+    if not isinstance(record, dict):
+        raise ValueError(f"invalid channel {record!r}")
+    if record.get("owner_id") is not None and not isinstance(record["owner_id"], int):
+        raise ValueError(f"invalid owner_id {record['owner_id']!r}")
+    for field in ("channel_username", "channel_title"):
+        if record.get(field) is not None and not isinstance(record[field], str):
+            raise ValueError(f"invalid {field} {record[field]!r}")
+    return int(record["channel_id"])
+
+def check_statuses(statuses):
+    """The added statuses of an imported channel, refused like /add_status would refuse them"""
+    names = {name for name, _ in BUILTIN_STATUSES}
+    for status in statuses:
+        if not isinstance(status, list) or len(status) != 2 or not all(isinstance(part, str) for part in status):
+            raise ValueError(f"invalid status {status!r}")
+        name = status[0]
+        if not STATUS_NAME.match(name) or name in names:
+            raise ValueError(f"invalid status name {name!r}")
+        names.add(name)
+    return statuses
+
+def check_rules(rules, statuses):
+    """The (status, trigger, phrase) rules of an imported channel; statuses are the ones check_statuses accepted"""
+    names = {name for name, _ in BUILTIN_STATUSES} | {name for name, _ in statuses}
+    for rule in rules:
+        if not isinstance(rule, list) or len(rule) != 3 or not all(isinstance(part, str) and part for part in rule):
+            raise ValueError(f"invalid rule {rule!r}")
+        if rule[0] not in names:
+            raise ValueError(f"rule for unknown status {rule[0]!r}")
+    return rules
+
+def check_images(images, statuses):
+    """The images of an imported channel, keyed by status, each a file_id or an exported row"""
+    names = {name for name, _ in BUILTIN_STATUSES} | {name for name, _ in statuses}
+    if not isinstance(images, dict):
+        raise ValueError(f"invalid images {images!r}")
+    for name, rows in images.items():
+        if name not in names:
+            raise ValueError(f"images for unknown status {name!r}")
+        if not isinstance(rows, list):
+            raise ValueError(f"invalid images {rows!r}")
+        for image in rows:
+            if isinstance(image, str) and image:
+                continue
+            if not isinstance(image, list) or not 1 <= len(image) <= 6 or not isinstance(image[0], str) or not image[0]:
+                raise ValueError(f"invalid image {image!r}")
+    return images
+
+def import_image(image):
+    # Exports hold [file_id, file_unique_id, width, height, file_size, dead]; a bare file_id is accepted too
+    row = image_row(image)
+    return (row + (None,) * 4)[:5] + (row[5] if len(row) == 6 else 0,)
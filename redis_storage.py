@@ -0,0 +1,553 @@
+"""Redis implementation of the storage helpers, for several bot workers sharing one state
+
+Selected with STORAGE_URL=redis://host:port/db. The functions mirror the SQLite helpers in
+storage.py and run on the same worker thread. Nothing is cached in the process: every read
+is one pipelined round trip, so ownership and sessions written by one worker are seen by
+the others on their next update.
+
+Keys, all under "tgbot:":
+    channel:<id>            hash owner_id, channel_username, channel_title
+    images:<id>:<status>    list of file_ids in rotation order
+    unique:<id>:<status>    set of file_unique_ids, to skip duplicate uploads
+    dead:<id>               set of file_ids of the channel that failed verification
+    rules:<id>              list of JSON [status, trigger, phrase]
+    statuses:<id>           list of JSON [name, label] added after the built-in red and green
+    sessions                hash user_id -> active channel_id
+    media                   hash file_id -> JSON [file_unique_id, width, height, file_size]
+    media:channels:<file>   set of channel ids using a file_id
+    media:verified          sorted set file_id -> last verification time, 0 if never
+    state:<kind>            hash key -> JSON, see persistence.py
+"""
+import json
+import time
+import redis
+from metrics import timed_query
+from classifier import BUILTIN_STATUSES
+from records import EXPORT_HEADER, image_row, dump_line, check_header, check_channel, check_statuses, check_rules, check_images, import_image
+
+PREFIX = "tgbot:"
+COLORS = tuple(name for name, _ in BUILTIN_STATUSES)
+
+_redis = None
+# channel_id -> (username, title) last written by this process, to skip no-op updates
+_channel_info = {}
+
+def _key(*parts):
+    return PREFIX + ":".join(str(part) for part in parts)
+
+def connect(url):
+    global _redis
+    _redis = redis.Redis.from_url(url, decode_responses=True)
+
+def init_db():
+    _redis.ping()
+
+def close_connections():
+    _redis.close()
+
+def _owner(value):
+    return int(value) if value else None
+
+def _custom_statuses(values):
+    return tuple(tuple(json.loads(value)) for value in values)
+
+def _status_names(channel_id):
+    return COLORS + tuple(name for name, _ in _custom_statuses(_redis.lrange(_key("statuses", channel_id), 0, -1)))
+
+@timed_query
+def get_channel_config(channel_id):
+    pipe = _redis.pipeline(transaction=False)
+    pipe.hgetall(_key("channel", channel_id))
+    pipe.lrange(_key("statuses", channel_id), 0, -1)
+    pipe.lrange(_key("rules", channel_id), 0, -1)
+    pipe.smembers(_key("dead", channel_id))
+    for color in COLORS:
+        pipe.lrange(_key("images", channel_id, color), 0, -1)
+    info, custom, rules, dead, *builtin = pipe.execute()
+    if not info:
+        return {"owner_id": None, "statuses": BUILTIN_STATUSES, "images": {name: [] for name in COLORS},
+                "channel_username": None, "channel_title": None, "rules": (), "dead_images": 0}
+    statuses = BUILTIN_STATUSES + _custom_statuses(custom)
+    # Only channels with statuses of their own need a second round trip
+    if custom:
+        for name, _ in statuses[len(COLORS):]:
+            pipe.lrange(_key("images", channel_id, name), 0, -1)
+        builtin += pipe.execute()
+    all_images = [file_id for images in builtin for file_id in images]
+    return {
+        "owner_id": _owner(info.get("owner_id")),
+        "statuses": statuses,
+        # Images that failed verification are left out so posts never try them
+        "images": {name: [file_id for file_id in images if file_id not in dead]
+                   for (name, _), images in zip(statuses, builtin)},
+        "channel_username": info.get("channel_username"),
+        "channel_title": info.get("channel_title"),
+        "rules": tuple(tuple(json.loads(rule)) for rule in rules),
+        "dead_images": sum(file_id in dead for file_id in all_images),
+    }
+
+@timed_query
+def set_channel_owner(channel_id, owner_id, username=None, title=None):
+    key = _key("channel", channel_id)
+    # HSETNX makes the first worker to claim a channel its owner, like INSERT OR IGNORE
+    if _redis.hsetnx(key, "owner_id", owner_id if owner_id is not None else ""):
+        _write_channel_info(key, username, title)
+    # The next update_channel_info has to reach the hash this call may have just created
+    _channel_info.pop(channel_id, None)
+
+def _write_channel_info(key, username, title):
+    pipe = _redis.pipeline()
+    for field, value in (("channel_username", username), ("channel_title", title)):
+        if value is None:
+            pipe.hdel(key, field)
+        else:
+            pipe.hset(key, field, value)
+    pipe.execute()
+
+@timed_query
+def update_channel_info(channel_id, username=None, title=None):
+    if _channel_info.get(channel_id) == (username, title):
+        return
+    key = _key("channel", channel_id)
+    # Only remembered once written: a channel that is not set up yet gets its info as soon as it is
+    if _redis.exists(key):
+        _write_channel_info(key, username, title)
+        _channel_info[channel_id] = (username, title)
+
+@timed_query
+def set_user_active_channel(user_id, channel_id):
+    _redis.hset(_key("sessions"), user_id, channel_id)
+
+@timed_query
+def get_user_active_channel(user_id):
+    channel_id = _redis.hget(_key("sessions"), user_id)
+    return int(channel_id) if channel_id else None
+
+def get_session(user_id):
+    """Active channel of a user together with its config, (None, None) without one"""
+    channel_id = get_user_active_channel(user_id)
+    if not channel_id:
+        return None, None
+    return channel_id, get_channel_config(channel_id)
+
+def _live_count(channel_id, color):
+    pipe = _redis.pipeline(transaction=False)
+    pipe.lrange(_key("images", channel_id, color), 0, -1)
+    pipe.smembers(_key("dead", channel_id))
+    images, dead = pipe.execute()
+    return sum(file_id not in dead for file_id in images)
+
+def _forget_unused(file_ids):
+    """Drop the verification and metadata entries of file_ids no channel uses any more"""
+    file_ids = list(file_ids)
+    if not file_ids:
+        return
+    keys = [_key("media", "channels", file_id) for file_id in file_ids]
+
+    def forget(pipe):
+        # Watched, so a channel adding one of these files meanwhile makes this run again
+        unused = [file_id for file_id, key in zip(file_ids, keys) if not pipe.exists(key)]
+        pipe.multi()
+        if unused:
+            pipe.zrem(_key("media", "verified"), *unused)
+            pipe.hdel(_key("media"), *unused)
+
+    _redis.transaction(forget, *keys)
+
+def _release_files(channel_id, file_ids):
+    """Detach file_ids the channel no longer lists under any status, then forget unused ones"""
+    file_ids = set(file_ids)
+    if not file_ids:
+        return
+    pipe = _redis.pipeline(transaction=False)
+    for name in _status_names(channel_id):
+        pipe.lrange(_key("images", channel_id, name), 0, -1)
+    file_ids -= {file_id for images in pipe.execute() for file_id in images}
+    for file_id in file_ids:
+        pipe.srem(_key("media", "channels", file_id), channel_id)
+    pipe.execute()
+    _forget_unused(file_ids)
+
+def _store_images(channel_id, color, images, replace):
+    """Append (or replace with) images in one MULTI, skipping pictures the channel already has"""
+    channel_key = _key("channel", channel_id)
+    list_key = _key("images", channel_id, color)
+    unique_key = _key("unique", channel_id, color)
+    rows = [image_row(image) for image in images]
+    replaced = []
+
+    def store(pipe):
+        replaced.clear()
+        if not pipe.exists(channel_key):
+            return 0
+        uniques = [row[1] for row in rows if row[1]]
+        seen = set()
+        if uniques and not replace:
+            seen = {unique for unique, present in zip(uniques, pipe.smismember(unique_key, uniques)) if present}
+        new = []
+        for row in rows:
+            if row[1]:
+                if row[1] in seen:
+                    continue
+                seen.add(row[1])
+            new.append(row)
+        if replace:
+            replaced.extend(pipe.lrange(list_key, 0, -1))
+        pipe.multi()
+        if replace:
+            pipe.delete(list_key, unique_key)
+        if new:
+            pipe.rpush(list_key, *[row[0] for row in new])
+            if any(row[1] for row in new):
+                pipe.sadd(unique_key, *[row[1] for row in new if row[1]])
+                pipe.hset(_key("media"), mapping={row[0]: json.dumps(row[1:]) for row in new if row[1]})
+            pipe.zadd(_key("media", "verified"), {row[0]: 0 for row in new}, nx=True)
+            for row in new:
+                pipe.sadd(_key("media", "channels", row[0]), channel_id)
+        return len(new)
+
+    added = _redis.transaction(store, channel_key, unique_key, list_key, value_from_callable=True)
+    _release_files(channel_id, replaced)
+    return added
+
+@timed_query
+def update_channel_image(channel_id, color, image):
+    """Replace all images of a status with a single one (for /set)"""
+    _store_images(channel_id, color, [image], replace=True)
+
+@timed_query
+def add_channel_image(channel_id, color, image):
+    """Returns (added, count): added is False when the channel already has this picture"""
+    added = _store_images(channel_id, color, [image], replace=False)
+    return added > 0, _live_count(channel_id, color)
+
+@timed_query
+def add_channel_images(channel_id, color, images):
+    """Append several images atomically, returns (how many were new, how many the color has now)"""
+    added = _store_images(channel_id, color, images, replace=False)
+    return added, _live_count(channel_id, color)
+
+@timed_query
+def remove_channel_image(channel_id, color, index):
+    """Remove an image by its index among the usable ones, returns False if there is no such image"""
+    if index < 0:
+        return False
+    list_key = _key("images", channel_id, color)
+    dead_key = _key("dead", channel_id)
+
+    def remove(pipe):
+        dead = pipe.smembers(dead_key)
+        live = [file_id for file_id in pipe.lrange(list_key, 0, -1) if file_id not in dead]
+        if index >= len(live):
+            return None
+        file_id = live[index]
+        meta = pipe.hget(_key("media"), file_id)
+        pipe.multi()
+        pipe.lrem(list_key, 1, file_id)
+        if meta and json.loads(meta)[0]:
+            pipe.srem(_key("unique", channel_id, color), json.loads(meta)[0])
+        return file_id
+
+    file_id = _redis.transaction(remove, list_key, dead_key, value_from_callable=True)
+    if file_id is None:
+        return False
+    _release_files(channel_id, [file_id])
+    return True
+
+@timed_query
+def images_to_verify(limit):
+    """file_ids that were checked least recently, never-checked ones first"""
+    return _redis.zrange(_key("media", "verified"), 0, limit - 1)
+
+@timed_query
+def record_verification(results):
+    """Store file_id check results, a list of (file_id, alive, file_unique_id, file_size)
+
+    alive is None when the check was inconclusive, then only the check time is stored.
+    Returns how many channels had an image change between usable and dead.
+    """
+    now = time.time()
+    pipe = _redis.pipeline(transaction=False)
+    for file_id, _, _, _ in results:
+        pipe.smembers(_key("media", "channels", file_id))
+    users = pipe.execute()
+    for (file_id, alive, _, _), channels in zip(results, users):
+        if alive is None:
+            continue
+        for channel_id in channels:
+            (pipe.srem if alive else pipe.sadd)(_key("dead", channel_id), file_id)
+    changes = pipe.execute()
+
+    pipe = _redis.pipeline(transaction=False)
+    for file_id, alive, file_unique_id, file_size in results:
+        pipe.zadd(_key("media", "verified"), {file_id: now}, xx=True)
+        if alive and file_unique_id:
+            pipe.hsetnx(_key("media"), file_id, json.dumps([file_unique_id, None, None, file_size]))
+    pipe.execute()
+    return sum(1 for changed in changes if changed)
+
+@timed_query
+def mark_image_dead(file_id):
+    """Flag a file_id Telegram refused, so the channels using it stop picking it"""
+    record_verification([(file_id, False, None, None)])
+
+@timed_query
+def add_channel_rule(channel_id, status, trigger, phrase):
+    _redis.rpush(_key("rules", channel_id), json.dumps([status, trigger, phrase], ensure_ascii=False))
+
+@timed_query
+def clear_channel_rules(channel_id):
+    _redis.delete(_key("rules", channel_id))
+
+@timed_query
+def add_channel_status(channel_id, name, label):
+    """Append a status after the existing ones, returns False if the channel already has it"""
+    channel_key = _key("channel", channel_id)
+    statuses_key = _key("statuses", channel_id)
+
+    def add(pipe):
+        if not pipe.exists(channel_key):
+            return False
+        if name in COLORS or any(existing == name for existing, _ in _custom_statuses(pipe.lrange(statuses_key, 0, -1))):
+            return False
+        pipe.multi()
+        pipe.rpush(statuses_key, json.dumps([name, label], ensure_ascii=False))
+        return True
+
+    return _redis.transaction(add, channel_key, statuses_key, value_from_callable=True)
+
+@timed_query
+def remove_channel_status(channel_id, name):
+    """Delete a custom status with its images and rules, returns False if there is no such status"""
+    statuses_key = _key("statuses", channel_id)
+    rules_key = _key("rules", channel_id)
+    released = []
+
+    def remove(pipe):
+        released.clear()
+        entries = pipe.lrange(statuses_key, 0, -1)
+        entry = next((value for value in entries if json.loads(value)[0] == name), None)
+        if entry is None:
+            return False
+        rules = [rule for rule in pipe.lrange(rules_key, 0, -1) if json.loads(rule)[0] != name]
+        names = COLORS + tuple(status for status, _ in _custom_statuses(entries))
+        others = {file_id for status in names if status != name
+                  for file_id in pipe.lrange(_key("images", channel_id, status), 0, -1)}
+        unused = set(pipe.lrange(_key("images", channel_id, name), 0, -1)) - others
+        pipe.multi()
+        pipe.lrem(statuses_key, 1, entry)
+        pipe.delete(rules_key, _key("images", channel_id, name), _key("unique", channel_id, name))
+        if rules:
+            pipe.rpush(rules_key, *rules)
+        for file_id in unused:
+            pipe.srem(_key("media", "channels", file_id), channel_id)
+        released.extend(unused)
+        return True
+
+    removed = _redis.transaction(remove, statuses_key, rules_key, _key("images", channel_id, name), value_from_callable=True)
+    _forget_unused(released)
+    return removed
+
+@timed_query
+def transfer_ownership(channel_id, new_owner_id):
+    channel_key = _key("channel", channel_id)
+
+    def transfer(pipe):
+        if pipe.exists(channel_key):
+            pipe.multi()
+            pipe.hset(channel_key, "owner_id", new_owner_id)
+
+    _redis.transaction(transfer, channel_key)
+
+@timed_query
+def remove_channel(channel_id):
+    names = _status_names(channel_id)
+    pipe = _redis.pipeline(transaction=False)
+    for name in names:
+        pipe.lrange(_key("images", channel_id, name), 0, -1)
+    file_ids = {file_id for images in pipe.execute() for file_id in images}
+
+    pipe = _redis.pipeline()
+    pipe.delete(_key("channel", channel_id), _key("rules", channel_id), _key("dead", channel_id), _key("statuses", channel_id),
+                *[_key(kind, channel_id, name) for kind in ("images", "unique") for name in names])
+    for file_id in file_ids:
+        pipe.srem(_key("media", "channels", file_id), channel_id)
+    pipe.execute()
+    _forget_unused(file_ids)
+    # Like the SQLite backend, users whose active channel this was have none afterwards
+    users = [user_id for user_id, active in _redis.hscan_iter(_key("sessions")) if active == str(channel_id)]
+    if users:
+        _redis.hdel(_key("sessions"), *users)
+    _channel_info.pop(channel_id, None)
+
+@timed_query
+def load_bot_state(kind):
+    """Stored (key, data JSON, updated_at) rows of one kind; updated_at is not kept here"""
+    return [(int(key), data, None) for key, data in _redis.hgetall(_key("state", kind)).items()]
+
+@timed_query
+def load_bot_state_entry(kind, key):
+    return _redis.hget(_key("state", kind), key)
+
+@timed_query
+def save_bot_state(changes):
+    """Write {(kind, key): data JSON or None to delete} in one MULTI"""
+    pipe = _redis.pipeline()
+    for (kind, key), data in changes.items():
+        if data is None:
+            pipe.hdel(_key("state", kind), key)
+        else:
+            pipe.hset(_key("state", kind), key, data)
+    pipe.execute()
+
+# Hashes prune_orphans walks and how to get the channel id of an entry: sessions map to a
+# channel id, chat_data is keyed by it
+_PRUNED = (
+    ("sessions", lambda field, value: int(value)),
+    ("state:chat", lambda field, value: int(field)),
+)
+# (index into _PRUNED, HSCAN cursor) the next prune_orphans call continues from
+_prune_position = (0, 0)
+
+@timed_query
+def prune_orphans(limit):
+    """Check one HSCAN page of about `limit` sessions or rotation states for removed channels
+
+    The cursor is kept between calls, so each call costs one page however big the hashes
+    are. Returns (deleted, more): more is False once every hash was scanned to its end.
+    """
+    global _prune_position
+    index, cursor = _prune_position
+    name, channel_of = _PRUNED[index]
+    key = _key(name)
+    cursor, page = _redis.hscan(key, cursor, count=limit)
+    entries = [(field, channel_of(field, value)) for field, value in page.items()]
+    entries = [(field, channel_id) for field, channel_id in entries if channel_id < 0]
+    pipe = _redis.pipeline(transaction=False)
+    for _, channel_id in entries:
+        pipe.exists(_key("channel", channel_id))
+    orphans = [field for (field, _), exists in zip(entries, pipe.execute()) if not exists]
+    deleted = _redis.hdel(key, *orphans) if orphans else 0
+    if cursor == 0:
+        index += 1
+    _prune_position = (index % len(_PRUNED), cursor)
+    return deleted, index < len(_PRUNED)
+
+def incremental_vacuum(pages):
+    """Redis frees memory by itself"""
+    return False
+
+def wal_checkpoint():
+    """Redis persistence is configured on the server"""
+    return 0
+
+@timed_query
+def table_stats():
+    pipe = _redis.pipeline(transaction=False)
+    pipe.hlen(_key("sessions"))
+    pipe.hlen(_key("media"))
+    pipe.dbsize()
+    sessions, media, keys = pipe.execute()
+    return {"user_sessions_rows": sessions, "media_rows": media, "keys": keys}
+
+@timed_query
+def export_channels(out, owner_id=None):
+    """Write channels as NDJSON in the same format as the SQLite backend, returns how many"""
+    out.write(dump_line(EXPORT_HEADER))
+    channel_ids = sorted(int(key.rsplit(":", 1)[1]) for key in _redis.scan_iter(_key("channel", "*")))
+    count = 0
+    for channel_id in channel_ids:
+        pipe = _redis.pipeline(transaction=False)
+        pipe.hgetall(_key("channel", channel_id))
+        pipe.lrange(_key("statuses", channel_id), 0, -1)
+        pipe.lrange(_key("rules", channel_id), 0, -1)
+        pipe.smembers(_key("dead", channel_id))
+        info, custom, rules, dead = pipe.execute()
+        owner = _owner(info.get("owner_id"))
+        if not info or (owner_id is not None and owner != owner_id):
+            continue
+        custom = _custom_statuses(custom)
+        names = COLORS + tuple(name for name, _ in custom)
+        for name in names:
+            pipe.lrange(_key("images", channel_id, name), 0, -1)
+        lists = pipe.execute()
+        all_images = [file_id for file_ids in lists for file_id in file_ids]
+        meta = dict(zip(all_images, _redis.hmget(_key("media"), all_images))) if all_images else {}
+        images = {
+            name: [[file_id, *(json.loads(meta[file_id]) if meta[file_id] else [None] * 4), int(file_id in dead)]
+                   for file_id in file_ids]
+            for name, file_ids in zip(names, lists)
+        }
+        out.write(dump_line({
+            "channel_id": channel_id, "owner_id": owner, "channel_username": info.get("channel_username"),
+            "channel_title": info.get("channel_title"), "statuses": [list(status) for status in custom],
+            "images": images, "rules": [json.loads(rule) for rule in rules],
+        }))
+        count += 1
+    return count
+
+@timed_query
+def import_channels(lines, owner_id=None):
+    """Load an export in one MULTI, replacing the statuses, images and rules of every channel in it
+
+    Lines are parsed one at a time while the transaction is queued; nothing is written
+    unless the whole file is valid. Returns (imported, skipped) like the SQLite backend.
+    """
+    pipe = _redis.pipeline()
+    imported = skipped = 0
+    # file_ids the imported channels used before, forgotten afterwards unless still in use
+    previous = set()
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if isinstance(record, dict) and "format" in record:
+            check_header(record)
+            continue
+        channel_id = check_channel(record)
+        statuses = check_statuses(record.get("statuses", []))
+        images = check_images(record.get("images", {}), statuses)
+        rules = check_rules(record.get("rules", []), statuses)
+        channel_key = _key("channel", channel_id)
+        owner = record.get("owner_id")
+        if owner_id is not None:
+            current = _owner(_redis.hget(channel_key, "owner_id"))
+            if current not in (None, owner_id):
+                skipped += 1
+                continue
+            owner = owner_id
+        names = _status_names(channel_id)
+        old = {file_id for name in names for file_id in _redis.lrange(_key("images", channel_id, name), 0, -1)}
+        pipe.delete(channel_key, _key("rules", channel_id), _key("dead", channel_id), _key("statuses", channel_id),
+                    *[_key(kind, channel_id, name) for kind in ("images", "unique") for name in names])
+        for file_id in old:
+            pipe.srem(_key("media", "channels", file_id), channel_id)
+        previous |= old
+        pipe.hset(channel_key, "owner_id", owner if owner is not None else "")
+        for field in ("channel_username", "channel_title"):
+            if record.get(field) is not None:
+                pipe.hset(channel_key, field, record[field])
+        if statuses:
+            pipe.rpush(_key("statuses", channel_id), *[json.dumps(list(status), ensure_ascii=False) for status in statuses])
+        for color, rows in images.items():
+            rows = [import_image(image) for image in rows]
+            if not rows:
+                continue
+            pipe.rpush(_key("images", channel_id, color), *[row[0] for row in rows])
+            uniques = [row[1] for row in rows if row[1]]
+            if uniques:
+                pipe.sadd(_key("unique", channel_id, color), *uniques)
+                pipe.hset(_key("media"), mapping={row[0]: json.dumps(row[1:5]) for row in rows if row[1]})
+            dead = [row[0] for row in rows if row[5]]
+            if dead:
+                pipe.sadd(_key("dead", channel_id), *dead)
+            pipe.zadd(_key("media", "verified"), {row[0]: 0 for row in rows}, nx=True)
+            for row in rows:
+                pipe.sadd(_key("media", "channels", row[0]), channel_id)
+        if rules:
+            pipe.rpush(_key("rules", channel_id), *[json.dumps(list(rule), ensure_ascii=False) for rule in rules])
+        _channel_info.pop(channel_id, None)
+        imported += 1
+    pipe.execute()
+    _forget_unused(previous)
+    return imported, skipped
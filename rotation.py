@@ -0,0 +1,73 @@
+import zlib
+import bisect
+import random
+
+class Deck:
+    """Cycles through the images of one channel status in shuffled order without repeats
+
+    The shuffle is the images sorted by a hash of (seed, file_id), so the position in a cycle
+    is fully described by the seed and the key of the last image drawn. That pair is all that
+    gets persisted, and when images are added or removed the deck is re-sorted and resumes
+    right after the last key: new images land at random places in the order, removed ones
+    simply disappear, and nothing already drawn this cycle comes up again.
+    """
+
+    __slots__ = ("images", "seed", "keys", "index")
+
+    def __init__(self, images, seed=None, last=None):
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.rebuild(images, last)
+
+    def _key(self, file_id):
+        return (zlib.crc32(f"{self.seed}:{file_id}".encode()), file_id)
+
+    def rebuild(self, images, last=None):
+        """Re-sort for a changed image list, keeping the place after `last` in the cycle"""
+        self.images = images
+        self.keys = sorted({self._key(file_id) for file_id in images})
+        self.index = bisect.bisect_right(self.keys, tuple(last)) if last else 0
+
+    def draw(self):
+        if not self.keys:
+            return None
+        if self.index >= len(self.keys):
+            previous = self.keys[-1][1]
+            # New cycle in a new order, never starting with the image that ended the last one
+            while True:
+                self.seed = random.getrandbits(32)
+                self.rebuild(self.images)
+                if len(self.keys) == 1 or self.keys[0][1] != previous:
+                    break
+        key = self.keys[self.index]
+        self.index += 1
+        return key[1]
+
+    def state(self):
+        """JSON-friendly [seed, last key] to resume from after a restart"""
+        return [self.seed, list(self.keys[self.index - 1]) if self.index else None]
+
+# (channel_id, status) -> Deck
+_decks = {}
+
+def draw_image(channel_id, status, images, saved):
+    """Next image for a post, or None when the status has no images
+
+    `images` is the list from the cached channel config; a different list object means the
+    images changed and the deck is rebuilt. `saved` is a dict kept across restarts (the
+    channel's chat_data), where the deck position is stored under "rotation".
+    """
+    if not images:
+        return None
+    deck = _decks.get((channel_id, status))
+    if deck is None:
+        seed, last = saved.get("rotation", {}).get(status) or (None, None)
+        deck = _decks[(channel_id, status)] = Deck(images, seed, last)
+    elif deck.images is not images:
+        # Without a config cache every post brings a fresh list, only rebuild on real changes
+        if deck.images == images:
+            deck.images = images
+        else:
+            deck.rebuild(images, deck.keys[deck.index - 1] if deck.index else None)
+    image_id = deck.draw()
+    saved.setdefault("rotation", {})[status] = deck.state()
+    return image_id
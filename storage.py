@@ -0,0 +1,721 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metrics import register_collector, timed_query
+from tracing import span
+from classifier import BUILTIN_STATUSES
+from records import EXPORT_HEADER, image_row, dump_line, check_header, check_channel, check_statuses, check_rules, check_images, import_image
+
+# Use data directory outside git repo
+DB_DIR = os.getenv("BOT_DATA_DIR") or os.path.expanduser("~/telegram_bot_data")
+os.makedirs(DB_DIR, exist_ok=True)
+DB_FILE = os.path.join(DB_DIR, "config.db")
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+# One long-lived connection per thread; the async helpers all go through a single
+# worker so writes are serialized and sqlite never blocks the event loop
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+# Parsed channel configs keyed by channel_id; every write helper below keeps it in sync
+_config_cache = {}
+_cache_stats = {"hits": 0, "misses": 0}
+# Active channel per user, kept in sync by set_user_active_channel and remove_channel
+_session_cache = {}
+_MISSING = object()
+
+def get_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+def close_connections():
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+    _local.__dict__.clear()
+
+async def run_db(func, *args):
+    """Run a blocking storage call on the sqlite worker thread"""
+    loop = asyncio.get_running_loop()
+    # Spans are opened here, contextvars do not follow the call onto the worker thread
+    with span(f"storage.{func.__name__}"):
+        return await loop.run_in_executor(_executor, functools.partial(func, *args))
+
+async def shutdown_db():
+    await run_db(backend.close_connections)
+    _executor.shutdown(wait=True)
+
+@timed_query
+def init_db():
+    conn = get_connection()
+    # An up-to-date database needs no DDL at all, which keeps restarts fast
+    if conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS):
+        return
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS channels (
+                channel_id INTEGER PRIMARY KEY,
+                owner_id INTEGER,
+                channel_username TEXT,
+                channel_title TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_sessions (
+                user_id INTEGER PRIMARY KEY,
+                active_channel_id INTEGER
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS channel_images (
+                id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                color TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                file_id TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_channel_images_position ON channel_images (channel_id, color, position)")
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, migrate in enumerate(MIGRATIONS[version:], version + 1):
+        with conn:
+            migrate(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+
+def _parse_images(value):
+    # JSON arrays, with fallback to a single image for backward compatibility
+    if not value:
+        return []
+    return json.loads(value) if value.startswith('[') else [value]
+
+def _migrate_images_table(conn):
+    """Move legacy red_image/green_image values into channel_images rows"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(channels)")}
+    if "red_image" not in columns:
+        return
+    rows = conn.execute("SELECT channel_id, red_image, green_image FROM channels").fetchall()
+    for channel_id, red_image, green_image in rows:
+        for color, value in (("red", red_image), ("green", green_image)):
+            conn.executemany("INSERT INTO channel_images (channel_id, color, position, file_id) VALUES (?, ?, ?, ?)",
+                             [(channel_id, color, position, file_id) for position, file_id in enumerate(_parse_images(value))])
+    conn.execute("UPDATE channels SET red_image = NULL, green_image = NULL")
+
+def _create_channel_rules(conn):
+    """Extra (trigger, phrase) pairs a channel adds on top of the default status rules"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_rules (
+            id INTEGER PRIMARY KEY,
+            channel_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            trigger TEXT NOT NULL,
+            phrase TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_rules_channel ON channel_rules (channel_id)")
+
+def _create_bot_state(conn):
+    """JSON snapshots of PTB user_data/chat_data, see persistence.py"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            kind TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+        )
+    """)
+
+def _add_image_metadata(conn):
+    """Telegram media details per image, plus the result of the last file_id check"""
+    for column in ("file_unique_id TEXT", "width INTEGER", "height INTEGER", "file_size INTEGER",
+                   "verified_at REAL", "dead INTEGER NOT NULL DEFAULT 0"):
+        conn.execute(f"ALTER TABLE channel_images ADD COLUMN {column}")
+    # The same picture uploaded twice gets a new file_id but keeps its file_unique_id
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_channel_images_unique ON channel_images (channel_id, color, file_unique_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_channel_images_file ON channel_images (file_id)")
+
+def _enable_incremental_vacuum(conn):
+    """Let maintenance return free pages a few at a time instead of a blocking full VACUUM"""
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # The mode only takes effect on an existing database after one full VACUUM
+    conn.execute("VACUUM")
+
+def _create_channel_statuses(conn):
+    """Statuses a channel adds after the built-in red and green
+
+    channel_images.color and channel_rules.status hold the status name.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_statuses (
+            channel_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            label TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (channel_id, name)
+        )
+    """)
+
+# Applied in order on startup; PRAGMA user_version records how many have run
+MIGRATIONS = [_migrate_images_table, _create_channel_rules, _create_bot_state, _add_image_metadata,
+              _enable_incremental_vacuum, _create_channel_statuses]
+
+def get_cache_stats():
+    """Return hit/miss counters and current size of the channel config cache"""
+    return {**_cache_stats, "size": len(_config_cache)}
+
+@register_collector
+def _cache_metrics():
+    stats = get_cache_stats()
+    return [
+        ("bot_config_cache_hits_total", "counter", "Channel config lookups served from memory", [({}, stats["hits"])]),
+        ("bot_config_cache_misses_total", "counter", "Channel config lookups that went to SQLite", [({}, stats["misses"])]),
+        ("bot_config_cache_entries", "gauge", "Channel configs currently cached", [({}, stats["size"])]),
+    ]
+
+def invalidate_channel_config(channel_id):
+    _config_cache.pop(channel_id, None)
+
+def get_channel_config(channel_id):
+    config = _config_cache.get(channel_id)
+    if config is not None:
+        _cache_stats["hits"] += 1
+        return config
+    _cache_stats["misses"] += 1
+    config = _load_channel_config(channel_id)
+    _config_cache[channel_id] = config
+    return config
+
+@timed_query
+def _load_channel_config(channel_id):
+    conn = get_connection()
+    cur = conn.execute("SELECT owner_id, channel_username, channel_title FROM channels WHERE channel_id = ?", (channel_id,))
+    row = cur.fetchone()
+    if row:
+        cur = conn.execute("SELECT name, label FROM channel_statuses WHERE channel_id = ? ORDER BY position", (channel_id,))
+        statuses = BUILTIN_STATUSES + tuple(cur.fetchall())
+        images = {name: [] for name, _ in statuses}
+        dead = 0
+        cur = conn.execute("SELECT color, file_id, dead FROM channel_images WHERE channel_id = ? ORDER BY color, position", (channel_id,))
+        for color, file_id, is_dead in cur:
+            # Images that failed verification are left out so posts never try them
+            if is_dead:
+                dead += 1
+            else:
+                images.setdefault(color, []).append(file_id)
+        cur = conn.execute("SELECT status, trigger, phrase FROM channel_rules WHERE channel_id = ? ORDER BY id", (channel_id,))
+        return {
+            "owner_id": row[0],
+            "statuses": statuses,
+            "images": images,
+            "channel_username": row[1],
+            "channel_title": row[2],
+            "rules": tuple(cur.fetchall()),
+            "dead_images": dead,
+        }
+    return {"owner_id": None, "statuses": BUILTIN_STATUSES, "images": {name: [] for name, _ in BUILTIN_STATUSES},
+            "channel_username": None, "channel_title": None, "rules": (), "dead_images": 0}
+
+@timed_query
+def set_channel_owner(channel_id, owner_id, username=None, title=None):
+    conn = get_connection()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO channels (channel_id, owner_id, channel_username, channel_title) VALUES (?, ?, ?, ?)",
+                     (channel_id, owner_id, username, title))
+    invalidate_channel_config(channel_id)
+
+def _channel_info_unchanged(channel_id, username, title):
+    cached = _config_cache.get(channel_id)
+    return cached is not None and cached["channel_username"] == username and cached["channel_title"] == title
+
+@timed_query
+def update_channel_info(channel_id, username=None, title=None):
+    if _channel_info_unchanged(channel_id, username, title):
+        return
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE channels SET channel_username = ?, channel_title = ? WHERE channel_id = ?",
+                     (username, title, channel_id))
+    cached = _config_cache.get(channel_id)
+    if cached:
+        cached["channel_username"] = username
+        cached["channel_title"] = title
+
+@timed_query
+def set_user_active_channel(user_id, channel_id):
+    conn = get_connection()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO user_sessions (user_id, active_channel_id) VALUES (?, ?)",
+                     (user_id, channel_id))
+    _session_cache[user_id] = channel_id
+
+@timed_query
+def _load_user_active_channel(user_id):
+    conn = get_connection()
+    cur = conn.execute("SELECT active_channel_id FROM user_sessions WHERE user_id = ?", (user_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def get_user_active_channel(user_id):
+    if user_id not in _session_cache:
+        _session_cache[user_id] = _load_user_active_channel(user_id)
+    return _session_cache[user_id]
+
+def get_session(user_id):
+    """Active channel of a user together with its config, (None, None) without one"""
+    channel_id = get_user_active_channel(user_id)
+    if not channel_id:
+        return None, None
+    return channel_id, get_channel_config(channel_id)
+
+def _cached_session(user_id):
+    """The session if it can be answered from memory, None when the database is needed"""
+    channel_id = _session_cache.get(user_id, _MISSING)
+    if channel_id is _MISSING:
+        return None
+    if channel_id is None:
+        return None, None
+    config = _config_cache.get(channel_id)
+    return (channel_id, config) if config is not None else None
+
+@timed_query
+def update_channel_image(channel_id, color, image):
+    """Replace all images of a status with a single one (for /set)"""
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM channel_images WHERE channel_id = ? AND color = ?", (channel_id, color))
+        conn.execute("""
+            INSERT INTO channel_images (channel_id, color, position, file_id, file_unique_id, width, height, file_size)
+            SELECT channel_id, ?, 0, ?, ?, ?, ?, ? FROM channels WHERE channel_id = ?
+        """, (color, *image_row(image), channel_id))
+    invalidate_channel_config(channel_id)
+
+@timed_query
+def add_channel_image(channel_id, color, image):
+    """Add an image to existing collection
+
+    Returns (added, count): added is False when the channel already has this picture.
+    """
+    conn = get_connection()
+    with conn:
+        cur = conn.execute("""
+            INSERT OR IGNORE INTO channel_images (channel_id, color, position, file_id, file_unique_id, width, height, file_size)
+            SELECT channel_id, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM channel_images WHERE channel_id = ? AND color = ?), ?, ?, ?, ?, ?
+            FROM channels WHERE channel_id = ?
+        """, (color, channel_id, color, *image_row(image), channel_id))
+        count = conn.execute("SELECT COUNT(*) FROM channel_images WHERE channel_id = ? AND color = ? AND dead = 0",
+                             (channel_id, color)).fetchone()[0]
+    invalidate_channel_config(channel_id)
+    return cur.rowcount > 0, count
+
+@timed_query
+def add_channel_images(channel_id, color, images):
+    """Append several images in one transaction, returns (how many were new, how many the color has now)"""
+    conn = get_connection()
+    added = 0
+    with conn:
+        if conn.execute("SELECT 1 FROM channels WHERE channel_id = ?", (channel_id,)).fetchone():
+            start = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM channel_images WHERE channel_id = ? AND color = ?",
+                                 (channel_id, color)).fetchone()[0]
+            before = conn.total_changes
+            conn.executemany("""
+                INSERT OR IGNORE INTO channel_images (channel_id, color, position, file_id, file_unique_id, width, height, file_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(channel_id, color, start + i, *image_row(image)) for i, image in enumerate(images)])
+            added = conn.total_changes - before
+        count = conn.execute("SELECT COUNT(*) FROM channel_images WHERE channel_id = ? AND color = ? AND dead = 0",
+                             (channel_id, color)).fetchone()[0]
+    invalidate_channel_config(channel_id)
+    return added, count
+
+@timed_query
+def remove_channel_image(channel_id, color, index):
+    """Remove an image by index, returns False if there is no such image"""
+    if index < 0:
+        return False
+    conn = get_connection()
+    with conn:
+        cur = conn.execute("""
+            DELETE FROM channel_images WHERE id = (
+                SELECT id FROM channel_images WHERE channel_id = ? AND color = ? AND dead = 0 ORDER BY position LIMIT 1 OFFSET ?
+            )
+        """, (channel_id, color, index))
+    invalidate_channel_config(channel_id)
+    return cur.rowcount > 0
+
+@timed_query
+def images_to_verify(limit):
+    """Distinct file_ids that were checked least recently, never-checked ones first"""
+    conn = get_connection()
+    cur = conn.execute("""
+        SELECT file_id FROM channel_images GROUP BY file_id ORDER BY MIN(COALESCE(verified_at, 0)) LIMIT ?
+    """, (limit,))
+    return [row[0] for row in cur]
+
+@timed_query
+def record_verification(results):
+    """Store file_id check results, a list of (file_id, alive, file_unique_id, file_size)
+
+    alive is None when the check was inconclusive: the id only gets its verified_at, so it
+    moves to the back of the queue. Metadata is only filled in where it is missing. Channels
+    whose usable images changed are dropped from the config cache.
+    """
+    conn = get_connection()
+    now = time.time()
+    changed = set()
+    with conn:
+        for file_id, alive, file_unique_id, file_size in results:
+            if alive is None:
+                conn.execute("UPDATE channel_images SET verified_at = ? WHERE file_id = ?", (now, file_id))
+                continue
+            dead = 0 if alive else 1
+            changed.update(row[0] for row in conn.execute(
+                "SELECT DISTINCT channel_id FROM channel_images WHERE file_id = ? AND dead != ?", (file_id, dead)))
+            conn.execute("UPDATE channel_images SET verified_at = ?, dead = ? WHERE file_id = ?", (now, dead, file_id))
+            if file_unique_id:
+                # Rows that would duplicate a picture the channel already has keep NULL
+                conn.execute("""
+                    UPDATE OR IGNORE channel_images SET file_unique_id = ?, file_size = COALESCE(file_size, ?)
+                    WHERE file_id = ? AND file_unique_id IS NULL
+                """, (file_unique_id, file_size, file_id))
+    for channel_id in changed:
+        invalidate_channel_config(channel_id)
+    return len(changed)
+
+@timed_query
+def mark_image_dead(file_id):
+    """Flag a file_id Telegram refused, so the channels using it stop picking it"""
+    record_verification([(file_id, False, None, None)])
+
+@timed_query
+def add_channel_rule(channel_id, status, trigger, phrase):
+    conn = get_connection()
+    with conn:
+        conn.execute("INSERT INTO channel_rules (channel_id, status, trigger, phrase) VALUES (?, ?, ?, ?)",
+                     (channel_id, status, trigger, phrase))
+    invalidate_channel_config(channel_id)
+
+@timed_query
+def clear_channel_rules(channel_id):
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM channel_rules WHERE channel_id = ?", (channel_id,))
+    invalidate_channel_config(channel_id)
+
+@timed_query
+def add_channel_status(channel_id, name, label):
+    """Append a status after the existing ones, returns False if the channel already has it"""
+    if any(name == builtin for builtin, _ in BUILTIN_STATUSES):
+        return False
+    conn = get_connection()
+    with conn:
+        cur = conn.execute("""
+            INSERT OR IGNORE INTO channel_statuses (channel_id, name, label, position)
+            SELECT channel_id, ?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM channel_statuses WHERE channel_id = ?)
+            FROM channels WHERE channel_id = ?
+        """, (name, label, channel_id, channel_id))
+    invalidate_channel_config(channel_id)
+    return cur.rowcount > 0
+
+@timed_query
+def remove_channel_status(channel_id, name):
+    """Delete a custom status with its images and rules, returns False if there is no such status"""
+    conn = get_connection()
+    with conn:
+        cur = conn.execute("DELETE FROM channel_statuses WHERE channel_id = ? AND name = ?", (channel_id, name))
+        if cur.rowcount:
+            conn.execute("DELETE FROM channel_images WHERE channel_id = ? AND color = ?", (channel_id, name))
+            conn.execute("DELETE FROM channel_rules WHERE channel_id = ? AND status = ?", (channel_id, name))
+    invalidate_channel_config(channel_id)
+    return cur.rowcount > 0
+
+@timed_query
+def transfer_ownership(channel_id, new_owner_id):
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE channels SET owner_id = ? WHERE channel_id = ?", (new_owner_id, channel_id))
+    invalidate_channel_config(channel_id)
+
+@timed_query
+def remove_channel(channel_id):
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
+        conn.execute("DELETE FROM channel_images WHERE channel_id = ?", (channel_id,))
+        conn.execute("DELETE FROM channel_rules WHERE channel_id = ?", (channel_id,))
+        conn.execute("DELETE FROM channel_statuses WHERE channel_id = ?", (channel_id,))
+        conn.execute("DELETE FROM user_sessions WHERE active_channel_id = ?", (channel_id,))
+    invalidate_channel_config(channel_id)
+    for user_id, active_channel_id in list(_session_cache.items()):
+        if active_channel_id == channel_id:
+            del _session_cache[user_id]
+
+@timed_query
+def load_bot_state(kind):
+    """Stored (key, data JSON, updated_at) rows of one kind"""
+    conn = get_connection()
+    return conn.execute("SELECT key, data, updated_at FROM bot_state WHERE kind = ?", (kind,)).fetchall()
+
+@timed_query
+def load_bot_state_entry(kind, key):
+    """Data JSON of one stored entry, None if there is none"""
+    conn = get_connection()
+    row = conn.execute("SELECT data FROM bot_state WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+    return row[0] if row else None
+
+@timed_query
+def save_bot_state(changes):
+    """Write {(kind, key): data JSON or None to delete} in one transaction"""
+    now = time.time()
+    conn = get_connection()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO bot_state (kind, key, data, updated_at) VALUES (?, ?, ?, ?)",
+                         [(kind, key, data, now) for (kind, key), data in changes.items() if data is not None])
+        conn.executemany("DELETE FROM bot_state WHERE kind = ? AND key = ?",
+                         [(kind, key) for (kind, key), data in changes.items() if data is None])
+
+@timed_query
+def prune_orphans(limit):
+    """Delete at most `limit` rows per table that belong to channels which no longer exist
+
+    Covers sessions whose active channel was removed and leftover images, rules, statuses and
+    rotation state (channel chat_data). Returns (deleted, more): more is True while some
+    table hit the limit and may have orphans left.
+    """
+    conn = get_connection()
+    counts = []
+    with conn:
+        users = [row[0] for row in conn.execute("""
+            SELECT user_id FROM user_sessions
+            WHERE active_channel_id IS NOT NULL AND active_channel_id NOT IN (SELECT channel_id FROM channels) LIMIT ?
+        """, (limit,))]
+        conn.executemany("DELETE FROM user_sessions WHERE user_id = ?", [(user_id,) for user_id in users])
+        counts.append(len(users))
+        for table in ("channel_images", "channel_rules", "channel_statuses"):
+            counts.append(conn.execute(f"""
+                DELETE FROM {table} WHERE rowid IN (
+                    SELECT rowid FROM {table} WHERE channel_id NOT IN (SELECT channel_id FROM channels) LIMIT ?
+                )
+            """, (limit,)).rowcount)
+        # Channel ids are negative; chat_data of private chats is left alone
+        counts.append(conn.execute("""
+            DELETE FROM bot_state WHERE rowid IN (
+                SELECT rowid FROM bot_state WHERE kind = 'chat' AND key < 0 AND key NOT IN (SELECT channel_id FROM channels) LIMIT ?
+            )
+        """, (limit,)).rowcount)
+    for user_id in users:
+        _session_cache.pop(user_id, None)
+    return sum(counts), max(counts) >= limit
+
+@timed_query
+def incremental_vacuum(pages):
+    """Return up to `pages` free pages to the filesystem, True while more are left"""
+    conn = get_connection()
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0] > 0
+
+@timed_query
+def wal_checkpoint():
+    """Copy the WAL into the database and truncate it, returns how many WAL bytes were released
+
+    All writes go through the single storage thread this runs on, so nothing waits on it.
+    """
+    wal_file = DB_FILE + "-wal"
+    size = os.path.getsize(wal_file) if os.path.exists(wal_file) else 0
+    busy = get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+    return 0 if busy else size
+
+@timed_query
+def table_stats():
+    """Row counts per table plus page usage, after letting SQLite refresh its planner statistics"""
+    conn = get_connection()
+    conn.execute("PRAGMA optimize")
+    stats = {f"{table}_rows": conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+             for table in ("channels", "user_sessions", "channel_images", "channel_rules", "channel_statuses", "bot_state")}
+    for pragma in ("page_count", "freelist_count", "page_size"):
+        stats[pragma] = conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+    return stats
+
+@timed_query
+def export_channels(out, owner_id=None):
+    """Write channels as NDJSON to a text file object, one line per channel
+
+    Only the channels of owner_id when it is given. Returns how many channels were written.
+    """
+    conn = get_connection()
+    out.write(dump_line(EXPORT_HEADER))
+    query, params = "SELECT channel_id, owner_id, channel_username, channel_title FROM channels", ()
+    if owner_id is not None:
+        query, params = query + " WHERE owner_id = ?", (owner_id,)
+    count = 0
+    for channel_id, owner, username, title in conn.execute(query + " ORDER BY channel_id", params).fetchall():
+        images = {"red": [], "green": []}
+        for color, *image in conn.execute("""
+            SELECT color, file_id, file_unique_id, width, height, file_size, dead
+            FROM channel_images WHERE channel_id = ? ORDER BY color, position
+        """, (channel_id,)):
+            images.setdefault(color, []).append(image)
+        rules = conn.execute("SELECT status, trigger, phrase FROM channel_rules WHERE channel_id = ? ORDER BY id", (channel_id,))
+        statuses = conn.execute("SELECT name, label FROM channel_statuses WHERE channel_id = ? ORDER BY position", (channel_id,))
+        out.write(dump_line({
+            "channel_id": channel_id, "owner_id": owner, "channel_username": username, "channel_title": title,
+            "statuses": [list(status) for status in statuses], "images": images, "rules": [list(rule) for rule in rules],
+        }))
+        count += 1
+    return count
+
+@timed_query
+def import_channels(lines, owner_id=None):
+    """Load channels written by export_channels, reading NDJSON lines one at a time
+
+    Everything runs in one transaction, so a broken line leaves the database as it was.
+    The statuses, images and rules of every imported channel are replaced. With owner_id the channels
+    are imported for that user: they get that owner, and channels someone else owns here
+    are skipped. Returns (imported, skipped).
+    """
+    conn = get_connection()
+    imported = []
+    skipped = 0
+    with conn:
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict) and "format" in record:
+                check_header(record)
+                continue
+            channel_id = check_channel(record)
+            statuses = check_statuses(record.get("statuses", []))
+            images = check_images(record.get("images", {}), statuses)
+            rules = check_rules(record.get("rules", []), statuses)
+            owner = record.get("owner_id")
+            if owner_id is not None:
+                row = conn.execute("SELECT owner_id FROM channels WHERE channel_id = ?", (channel_id,)).fetchone()
+                if row and row[0] not in (None, owner_id):
+                    skipped += 1
+                    continue
+                owner = owner_id
+            conn.execute("INSERT OR REPLACE INTO channels (channel_id, owner_id, channel_username, channel_title) VALUES (?, ?, ?, ?)",
+                         (channel_id, owner, record.get("channel_username"), record.get("channel_title")))
+            conn.execute("DELETE FROM channel_images WHERE channel_id = ?", (channel_id,))
+            conn.execute("DELETE FROM channel_rules WHERE channel_id = ?", (channel_id,))
+            conn.execute("DELETE FROM channel_statuses WHERE channel_id = ?", (channel_id,))
+            conn.executemany("INSERT OR IGNORE INTO channel_statuses (channel_id, name, label, position) VALUES (?, ?, ?, ?)",
+                             [(channel_id, name, label, position)
+                              for position, (name, label) in enumerate(statuses)])
+            for color, rows in images.items():
+                conn.executemany("""
+                    INSERT OR IGNORE INTO channel_images (channel_id, color, position, file_id, file_unique_id, width, height, file_size, dead)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(channel_id, color, position, *import_image(image)) for position, image in enumerate(rows)])
+            conn.executemany("INSERT INTO channel_rules (channel_id, status, trigger, phrase) VALUES (?, ?, ?, ?)",
+                             [(channel_id, status, trigger, phrase) for status, trigger, phrase in rules])
+            imported.append(channel_id)
+    for channel_id in imported:
+        invalidate_channel_config(channel_id)
+    return len(imported), skipped
+
+# Where the async helpers below read and write: the SQLite functions above, or a store
+# several bot workers share (STORAGE_URL=redis://..., see redis_storage.py). A shared store
+# is never cached in the process, so the fast paths below simply fall through to it.
+STORAGE_URL = os.getenv("STORAGE_URL")
+if STORAGE_URL:
+    import redis_storage as backend
+    backend.connect(STORAGE_URL)
+else:
+    backend = sys.modules[__name__]
+SHARED = backend is not sys.modules[__name__]
+
+def init_storage():
+    """Create or migrate the configured store before the bot starts"""
+    backend.init_db()
+
+def export_channels_file(path, owner_id=None):
+    """export_channels into a file, "-" for stdout"""
+    if path == "-":
+        return backend.export_channels(sys.stdout, owner_id)
+    with open(path, "w", encoding="utf-8") as f:
+        return backend.export_channels(f, owner_id)
+
+def import_channels_file(path, owner_id=None):
+    """import_channels from a file, "-" for stdin; the file is streamed, never read whole"""
+    if path == "-":
+        return backend.import_channels(sys.stdin, owner_id)
+    with open(path, encoding="utf-8") as f:
+        return backend.import_channels(f, owner_id)
+
+def _async(func):
+    @functools.wraps(func)
+    async def wrapper(*args):
+        return await run_db(func, *args)
+    return wrapper
+
+# Async versions of every helper; cache hits are answered on the event loop
+# without a thread hop
+
+async def aget_channel_config(channel_id):
+    config = _config_cache.get(channel_id)
+    if config is not None:
+        _cache_stats["hits"] += 1
+        return config
+    return await run_db(backend.get_channel_config, channel_id)
+
+async def aupdate_channel_info(channel_id, username=None, title=None):
+    if _channel_info_unchanged(channel_id, username, title):
+        return
+    await run_db(backend.update_channel_info, channel_id, username, title)
+
+async def aget_session(user_id):
+    session = _cached_session(user_id)
+    if session is not None:
+        return session
+    return await run_db(backend.get_session, user_id)
+
+ainit_db = _async(backend.init_db)
+aset_channel_owner = _async(backend.set_channel_owner)
+aset_user_active_channel = _async(backend.set_user_active_channel)
+aupdate_channel_image = _async(backend.update_channel_image)
+aadd_channel_image = _async(backend.add_channel_image)
+aadd_channel_images = _async(backend.add_channel_images)
+aimages_to_verify = _async(backend.images_to_verify)
+arecord_verification = _async(backend.record_verification)
+amark_image_dead = _async(backend.mark_image_dead)
+aremove_channel_image = _async(backend.remove_channel_image)
+aadd_channel_rule = _async(backend.add_channel_rule)
+aclear_channel_rules = _async(backend.clear_channel_rules)
+aadd_channel_status = _async(backend.add_channel_status)
+aremove_channel_status = _async(backend.remove_channel_status)
+atransfer_ownership = _async(backend.transfer_ownership)
+aremove_channel = _async(backend.remove_channel)
+aload_bot_state = _async(backend.load_bot_state)
+aload_bot_state_entry = _async(backend.load_bot_state_entry)
+asave_bot_state = _async(backend.save_bot_state)
+aexport_channels = _async(backend.export_channels)
+aprune_orphans = _async(backend.prune_orphans)
+aincremental_vacuum = _async(backend.incremental_vacuum)
+awal_checkpoint = _async(backend.wal_checkpoint)
+atable_stats = _async(backend.table_stats)
+aimport_channels_file = _async(import_channels_file)
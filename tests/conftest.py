@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# Modules are imported from the repository root, and storage writes to a scratch directory
+# that has to be set before anything imports it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["BOT_DATA_DIR"] = tempfile.mkdtemp(prefix="tests_")
+os.environ.pop("STORAGE_URL", None)
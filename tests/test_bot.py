@@ -0,0 +1,21 @@
+"""Private-chat handlers driven with stand-in updates"""
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+def photo_update(replies):
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    message = SimpleNamespace(chat=SimpleNamespace(type="private"), photo=[SimpleNamespace(file_id="photo")],
+                              reply_text=reply_text)
+    return SimpleNamespace(message=message, effective_message=message, effective_user=SimpleNamespace(id=1))
+
+def test_photo_while_waiting_for_import_keeps_waiting():
+    replies = []
+    context = SimpleNamespace(user_data={"waiting_for": "import", "waiting_since": 0},
+                              application=SimpleNamespace(persistence=None))
+    asyncio.run(bot.handle_photo(photo_update(replies), context))
+    assert replies == ["📎 Надішліть файл експорту як документ"]
+    assert context.user_data["waiting_for"] == "import"
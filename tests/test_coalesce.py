@@ -0,0 +1,24 @@
+"""PostWindow flap coalescing and pruning"""
+import time
+from types import SimpleNamespace
+
+from coalesce import PostWindow
+
+def arrive(window, channel_id, message_id, text):
+    window.arrived(SimpleNamespace(channel_post=SimpleNamespace(chat_id=channel_id, message_id=message_id, text=text)))
+
+def test_newer_post_supersedes_only_when_its_status_has_images():
+    window = PostWindow(window=300, flap_window=10)
+    arrive(window, -1, 1, "🔴 світло зникло")
+    arrive(window, -1, 2, "🟢 світло є")
+    assert window.record(-1, 1, "red")
+    classify = {"🟢 світло є": "green"}.get
+    assert not window.superseded(-1, 1, classify, lambda status: status == "red")
+    assert window.superseded(-1, 1, classify, lambda status: status == "green")
+
+def test_quiet_channels_are_dropped():
+    window = PostWindow(window=0.01, flap_window=0)
+    window.record(-1, 1, "red")
+    time.sleep(0.02)
+    window.record(-2, 1, "red")
+    assert list(window._channels) == [-2]
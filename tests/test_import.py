@@ -0,0 +1,40 @@
+"""Imports refuse malformed rule and image rows before anything is written"""
+import json
+import pytest
+
+import storage
+from records import EXPORT_HEADER
+
+CHANNEL_ID = -1002
+
+def import_lines(*records):
+    return storage.import_channels([json.dumps(EXPORT_HEADER)] + [json.dumps(record) for record in records])
+
+def test_import_keeps_valid_rows():
+    storage.init_db()
+    record = {"channel_id": CHANNEL_ID, "owner_id": 1, "statuses": [["blue", "🔵"]],
+              "images": {"red": ["a"], "blue": [["b", "ub", 1, 2, 3]]},
+              "rules": [["blue", "🔵", "синє"], ["red", "🔴", "світло зникло"]]}
+    assert import_lines(record) == (1, 0)
+    config = storage.get_channel_config(CHANNEL_ID)
+    assert config["images"]["red"] == ["a"] and config["images"]["blue"] == ["b"]
+    assert ("blue", "🔵", "синє") in [tuple(rule) for rule in config["rules"]]
+
+@pytest.mark.parametrize("record", [
+    {"rules": [["red", "🔴", None]]},
+    {"rules": [["red", "", "світло"]]},
+    {"rules": [["purple", "🟣", "світло"]]},
+    {"rules": ["red"]},
+    {"images": {"purple": ["a"]}},
+    {"images": {"red": [[None]]}},
+    {"images": {"red": "a"}},
+    {"channel_title": {"title": 1}},
+])
+def test_import_refuses_bad_rows(record):
+    storage.init_db()
+    storage.remove_channel(CHANNEL_ID)
+    storage.set_channel_owner(CHANNEL_ID, 1)
+    storage.add_channel_images(CHANNEL_ID, "red", ["kept"])
+    with pytest.raises(ValueError):
+        import_lines({"channel_id": CHANNEL_ID, **record})
+    assert storage.get_channel_config(CHANNEL_ID)["images"]["red"] == ["kept"]
@@ -0,0 +1,45 @@
+"""Background file_id verification with a fake getFile"""
+import asyncio
+from types import SimpleNamespace
+from telegram.error import BadRequest
+
+import storage
+from media import is_bad_file, verify_media
+
+CHANNEL_ID = -1001
+
+def setup_channel(file_ids):
+    storage.init_db()
+    storage.remove_channel(CHANNEL_ID)
+    storage.set_channel_owner(CHANNEL_ID, 1)
+    storage.add_channel_images(CHANNEL_ID, "red", file_ids)
+
+def run_verification(errors, batch):
+    """Run verify_media once; getFile raises BadRequest(errors[file_id]) for the ids listed"""
+    checked = []
+
+    async def get_file(file_id, rate_limit_args=None):
+        checked.append(file_id)
+        if file_id in errors:
+            raise BadRequest(errors[file_id])
+        return SimpleNamespace(file_unique_id=f"u-{file_id}", file_size=1)
+
+    context = SimpleNamespace(bot=SimpleNamespace(rate_limiter=None, get_file=get_file), job=SimpleNamespace(data=batch))
+    asyncio.run(verify_media(context))
+    return checked
+
+def test_getfile_errors_mark_images_dead():
+    setup_channel(["dead-1", "dead-2", "alive"])
+    run_verification({"dead-1": "Invalid file_id", "dead-2": "Wrong file_id or the file is temporarily unavailable"}, 3)
+    assert storage.get_channel_config(CHANNEL_ID)["images"]["red"] == ["alive"]
+    assert is_bad_file(BadRequest("Wrong file identifier/http url specified"))
+
+def test_unmatched_bad_request_still_moves_the_queue():
+    setup_channel(["a", "b", "c"])
+    errors = {file_id: "Something unexpected" for file_id in ("a", "b", "c")}
+    first = run_verification(errors, 2)
+    # The ids that failed for an unknown reason are not retried before the unchecked one
+    second = run_verification(errors, 1)
+    assert len(first) == 2 and second == sorted({"a", "b", "c"} - set(first))
+    # and they are not treated as dead
+    assert sorted(storage.get_channel_config(CHANNEL_ID)["images"]["red"]) == ["a", "b", "c"]
@@ -0,0 +1,143 @@
+"""PriorityRateLimiter against a local fake Bot API server that answers 429s
+
+The bot talks to the server through PTB's real HTTP stack, so RetryAfter is raised from an
+actual 429 response exactly as it would be with Telegram.
+"""
+import time
+import asyncio
+from aiohttp import web
+from telegram.ext import ExtBot
+from ratelimit import PriorityRateLimiter
+
+TOKEN = "1:test"
+
+class FakeBotApi:
+    """Answers sendMessage like Telegram, or with a 429 for the chats in `limited`"""
+
+    def __init__(self):
+        # chat_id -> how many more requests get a 429
+        self.limited = {}
+        self.retry_after = 1
+        # (chat_id, seconds since start, status)
+        self.requests = []
+        self.started = time.monotonic()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "test", "username": "test_bot"}})
+        data = await request.post()
+        chat_id = int(data["chat_id"])
+        if self.limited.get(chat_id, 0) > 0:
+            self.limited[chat_id] -= 1
+            self.requests.append((chat_id, time.monotonic() - self.started, 429))
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                      "parameters": {"retry_after": self.retry_after}}, status=429)
+        self.requests.append((chat_id, time.monotonic() - self.started, 200))
+        return web.json_response({"ok": True, "result": {
+            "message_id": 1, "date": 0, "text": data["text"],
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+        }})
+
+    def times(self, chat_id, status=None):
+        return [at for chat, at, code in self.requests if chat == chat_id and status in (None, code)]
+
+async def run_with_bot(limiter, scenario):
+    api = FakeBotApi()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    bot = ExtBot(TOKEN, base_url=f"http://127.0.0.1:{port}/bot", rate_limiter=limiter)
+    try:
+        await bot.initialize()
+        api.requests.clear()
+        api.started = time.monotonic()
+        await scenario(bot, api)
+    finally:
+        await bot.shutdown()
+        await runner.cleanup()
+    return api
+
+def test_retries_after_429():
+    limiter = PriorityRateLimiter()
+
+    async def scenario(bot, api):
+        api.limited[-100] = 1
+        message = await bot.send_message(-100, "🔴")
+        assert message.chat_id == -100
+
+    api = asyncio.run(run_with_bot(limiter, scenario))
+    limited, served = api.times(-100, 429), api.times(-100, 200)
+    assert len(limited) == 1 and len(served) == 1
+    # Retried once, no earlier than retry_after
+    assert served[0] - limited[0] >= api.retry_after - 0.05
+    assert limiter.counters["retries"] == 1
+    assert limiter.counters["errors"] == 0
+
+def test_429_pauses_only_its_chat():
+    limiter = PriorityRateLimiter()
+
+    async def scenario(bot, api):
+        api.limited[-100] = 1
+        limited = asyncio.create_task(bot.send_message(-100, "🔴"))
+        while not api.requests:
+            await asyncio.sleep(0.01)
+        # The limited chat is paused for a second; another chat goes through meanwhile
+        await bot.send_message(-200, "🟢")
+        assert not limited.done()
+        await limited
+
+    api = asyncio.run(run_with_bot(limiter, scenario))
+    assert api.times(-200)[0] < 0.5
+    assert api.times(-200)[0] < api.times(-100, 200)[0]
+    assert api.times(-100, 200)[0] >= api.retry_after - 0.05
+
+def test_channel_requests_overtake_dms():
+    # Four tokens up front, then one every 0.25s, so the rest of the queue is served in order
+    limiter = PriorityRateLimiter(overall_rate=4)
+    channels = [-101, -102, -103, -104]
+    users = [201, 202, 203, 204]
+
+    async def scenario(bot, api):
+        # DMs are queued first, channel edits after them
+        await asyncio.gather(*[bot.send_message(chat_id, "x") for chat_id in users + channels])
+
+    api = asyncio.run(run_with_bot(limiter, scenario))
+    order = [chat_id for chat_id, _, _ in sorted(api.requests, key=lambda request: request[1])]
+    assert sorted(order[:4]) == sorted(channels)
+    assert sorted(order[4:]) == sorted(users)
+
+def test_gives_up_after_max_retries():
+    limiter = PriorityRateLimiter(max_retries=1)
+
+    async def scenario(bot, api):
+        from telegram.error import RetryAfter
+
+        api.limited[-100] = 5
+        try:
+            await bot.send_message(-100, "🔴")
+        except RetryAfter:
+            pass
+        else:
+            raise AssertionError("RetryAfter was not raised")
+
+    api = asyncio.run(run_with_bot(limiter, scenario))
+    assert len(api.times(-100, 429)) == 2
+    assert limiter.counters["errors"] == 1
+
+def test_idle_chat_buckets_are_dropped():
+    limiter = PriorityRateLimiter(private_rate=100, sweep_interval=0)
+
+    async def scenario(bot, api):
+        await bot.send_message(201, "x")
+        assert 201 in limiter._chats
+        # Refilled by now; the sweep before the next request drops it
+        await asyncio.sleep(0.05)
+        await bot.send_message(202, "x")
+
+    asyncio.run(run_with_bot(limiter, scenario))
+    assert 201 not in limiter._chats
@@ -0,0 +1,170 @@
+"""Opt-in per-update tracing
+
+With TRACE_SAMPLE_RATE above 0, that fraction of updates is traced: the handler gets a root
+span and every span() opened while it runs (storage calls, classification, Bot API calls and
+the rate limiter wait) becomes a child. A finished trace is written as one JSON line to
+TRACE_FILE, or sent in batches to an OTLP/HTTP collector when TRACE_OTLP_URL is set, e.g.
+http://localhost:4318/v1/traces.
+
+When tracing is off, handlers are not wrapped at all and span() costs one ContextVar lookup.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import contextlib
+import contextvars
+import functools
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_URL = os.getenv("TRACE_OTLP_URL")
+# Seconds between OTLP batches
+TRACE_OTLP_INTERVAL = float(os.getenv("TRACE_OTLP_INTERVAL", 5))
+ENABLED = TRACE_SAMPLE_RATE > 0
+SERVICE_NAME = "tg_bot_image"
+
+logger = logging.getLogger(__name__)
+
+# (trace, index of the open span) while a sampled update is being handled
+_current = contextvars.ContextVar("span", default=None)
+_NOOP = contextlib.nullcontext()
+
+class Trace:
+    __slots__ = ("trace_id", "started_ns", "origin", "spans")
+
+    def __init__(self):
+        self.trace_id = random.getrandbits(128)
+        self.started_ns = time.time_ns()
+        self.origin = time.perf_counter()
+        # [name, parent index or None, start, end, attributes], perf_counter times
+        self.spans = []
+
+class _Span:
+    __slots__ = ("trace", "parent", "name", "attributes", "index", "token")
+
+    def __init__(self, trace, parent, name, attributes):
+        self.trace = trace
+        self.parent = parent
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.index = len(self.trace.spans)
+        self.trace.spans.append([self.name, self.parent, time.perf_counter(), None, self.attributes])
+        self.token = _current.set((self.trace, self.index))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        entry = self.trace.spans[self.index]
+        entry[3] = time.perf_counter()
+        if exc_type is not None:
+            entry[4]["error"] = exc_type.__name__
+        _current.reset(self.token)
+
+def span(name, **attributes):
+    """Time a block as a child of the current span; a shared no-op when the update is not sampled"""
+    current = _current.get()
+    if current is None:
+        return _NOOP
+    return _Span(current[0], current[1], name, attributes)
+
+def traced_handler(callback):
+    """Give a sampled update a root span around its PTB handler; returns callback itself when tracing is off"""
+    if not ENABLED:
+        return callback
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        if random.random() >= TRACE_SAMPLE_RATE:
+            return await callback(update, context)
+        trace = Trace()
+        chat = getattr(update, "effective_chat", None)
+        attributes = {"update_id": getattr(update, "update_id", None), "chat_id": chat.id if chat else None}
+        try:
+            with _Span(trace, None, name, attributes):
+                return await callback(update, context)
+        finally:
+            _exporter.export(trace)
+    return wrapper
+
+class JsonLinesExporter:
+    """One compact JSON line per trace, span times in ms relative to the start of the update"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def export(self, trace):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+        spans = [
+            {"name": name, "parent": parent, "start_ms": round((start - trace.origin) * 1000, 3),
+             "ms": round((end - start) * 1000, 3), **({"attrs": attributes} if attributes else {})}
+            for name, parent, start, end, attributes in trace.spans if end is not None
+        ]
+        self._file.write(json.dumps({"trace": format(trace.trace_id, "032x"), "ts": trace.started_ns / 1e9,
+                                     "spans": spans}, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+class OtlpExporter:
+    """Batches traces and POSTs them as OTLP/HTTP JSON every TRACE_OTLP_INTERVAL seconds"""
+
+    def __init__(self, url, interval):
+        self.url = url
+        self.interval = interval
+        self._spans = []
+        self._task = None
+
+    def export(self, trace):
+        ids = [format(random.getrandbits(64), "016x") for _ in trace.spans]
+        trace_id = format(trace.trace_id, "032x")
+        for (name, parent, start, end, attributes), span_id in zip(trace.spans, ids):
+            # Tasks started by the handler may still be running
+            if end is None:
+                continue
+            otlp_span = {
+                "traceId": trace_id, "spanId": span_id, "name": name, "kind": 1,
+                "startTimeUnixNano": str(trace.started_ns + int((start - trace.origin) * 1e9)),
+                "endTimeUnixNano": str(trace.started_ns + int((end - trace.origin) * 1e9)),
+                "attributes": [{"key": key, "value": _otlp_value(value)}
+                               for key, value in attributes.items() if value is not None],
+            }
+            if parent is not None:
+                otlp_span["parentSpanId"] = ids[parent]
+            self._spans.append(otlp_span)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._send_batches())
+
+    async def _send_batches(self):
+        import aiohttp
+
+        async with aiohttp.ClientSession() as session:
+            while True:
+                await asyncio.sleep(self.interval)
+                if not self._spans:
+                    continue
+                spans, self._spans = self._spans, []
+                body = {"resourceSpans": [{
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                    "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": spans}],
+                }]}
+                try:
+                    async with session.post(self.url, json=body) as response:
+                        if response.status >= 400:
+                            logger.warning("Trace collector answered %s, dropped %d spans", response.status, len(spans))
+                except aiohttp.ClientError as exc:
+                    logger.warning("Could not send %d spans to the trace collector: %s", len(spans), exc)
+
+_exporter = OtlpExporter(TRACE_OTLP_URL, TRACE_OTLP_INTERVAL) if TRACE_OTLP_URL else JsonLinesExporter(TRACE_FILE)
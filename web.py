@@ -0,0 +1,60 @@
+import hmac
+from aiohttp import web
+from telegram import Update
+from metrics import render
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+_runner = None
+
+async def health(request):
+    return web.Response(text="Bot is running")
+
+async def metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Prometheus-Format": "0.0.4"})
+
+async def webhook(request):
+    secret_token = request.app["secret_token"]
+    if secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret_token):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict):
+        return web.Response(status=400)
+
+    application = request.app["application"]
+    try:
+        update = Update.de_json(data, application.bot)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return web.Response(status=400)
+    if update is None:
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response()
+
+def create_web_app(application, webhook_path=None, secret_token=None):
+    """Health checks and metrics, plus Telegram updates on webhook_path when it is given"""
+    web_app = web.Application()
+    web_app["application"] = application
+    web_app["secret_token"] = secret_token
+    web_app.router.add_get("/", health)
+    web_app.router.add_get("/health", health)
+    web_app.router.add_get("/metrics", metrics)
+    if webhook_path:
+        web_app.router.add_post(webhook_path, webhook)
+    return web_app
+
+async def start_web_server(web_app, port):
+    global _runner
+    _runner = web.AppRunner(web_app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, "0.0.0.0", port).start()
+
+async def stop_web_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None